@@ -1,23 +1,35 @@
-import datetime
 import logging
 import mimetypes
-import time
-import glob
 import os
-import random
-import string
-import uuid
 import re
-
-from storage import get_storage
+import io
+import tempfile
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from cache import MemoryCache, ResizedImageCache
+from deduplication import DeduplicationIndex
+from janitor import Janitor
+from jobs import JobFailedError, JobPool, JobTimeoutError, QueueFullError
+from storage import (
+    DirectUploadStorage,
+    InvalidRangeError,
+    NotModifiedError,
+    get_storage,
+    get_validators,
+    is_not_modified,
+)
 import filetype
-import timeout_decorator
-from flask import Flask, jsonify, request, Response, send_file, send_from_directory, current_app
+import images
+import names
+import instrumentation
+from flask import Flask, g, jsonify, redirect, request, Request, Response, send_file, send_from_directory, current_app
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from wand.exceptions import MissingDelegateError
-from wand.image import Image
+from wand.exceptions import MissingDelegateError, ResourceLimitError
+from werkzeug.datastructures import ContentRange
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 import settings
@@ -34,7 +46,17 @@ logger = logging.getLogger(__name__)
 
 logger.info("imgpush is starting...")
 
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Werkzeug spills the uploaded files to disk beyond 500 KB, they are kept in memory up to MAX_SPOOL_SIZE_MB
+        return tempfile.SpooledTemporaryFile(
+            max_size=settings.MAX_SPOOL_SIZE_MB * 1024 * 1024, mode="rb+"
+        )
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
 app.logger.setLevel(logging.INFO)
@@ -47,6 +69,26 @@ storage = get_storage()
 logger.info("Using storage: %s" % storage.__class__.__name__)
 logger.info(storage)
 
+resized_image_cache = ResizedImageCache()
+memory_cache = MemoryCache()
+job_pool = JobPool(
+    settings.JOB_WORKERS,
+    settings.JOB_QUEUE_SIZE,
+    settings.JOB_TIMEOUT,
+    preload=["images"],
+    initializer=images.apply_resource_limits,
+)
+deduplication_index = DeduplicationIndex() if settings.DEDUPLICATE_UPLOADS else None
+janitor = Janitor(settings.JANITOR_INTERVAL, settings.MAX_TMP_FILE_AGE)
+janitor.start()
+# Formats offered to the clients that accept them, among those the local ImageMagick build can write
+negotiated_output_types = [
+    output_type
+    for output_type in settings.NEGOTIATED_OUTPUT_TYPES
+    if images.can_encode(output_type)
+]
+logger.info("Negotiated output types: %s", negotiated_output_types)
+
 logger.info("-" * 40)
 
 CORS(app, origins=settings.ALLOWED_ORIGINS)
@@ -55,19 +97,76 @@ limiter = Limiter(get_remote_address, app=app, default_limits=[])
 
 logger.info("imgpush is listening on port 5000!")
 
-app.use_x_sendfile = True
+# send_file only sets an X-Sendfile header, which after_request turns into an X-Accel-Redirect for nginx
+app.config["USE_X_SENDFILE"] = settings.NGINX_ACCEL_REDIRECT
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    instrumentation.REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request_metrics(resp):
+    endpoint = request.endpoint or "unknown"
+    instrumentation.REQUESTS.labels(endpoint, request.method, resp.status_code).inc()
+    instrumentation.REQUEST_DURATION_SECONDS.labels(endpoint, request.method).observe(
+        time.perf_counter() - g.request_started_at
+    )
+    if request.content_length:
+        instrumentation.REQUEST_BYTES.labels(endpoint).inc(request.content_length)
+    if resp.content_length:
+        instrumentation.RESPONSE_BYTES.labels(endpoint).inc(resp.content_length)
+    return resp
+
+
+@app.teardown_request
+def end_request_metrics(exception):
+    if "request_started_at" in g:
+        instrumentation.REQUESTS_IN_FLIGHT.dec()
 
 
 @app.after_request
 def after_request(resp):
     x_sendfile = resp.headers.get("X-Sendfile")
     if x_sendfile:
-        resp.headers["X-Accel-Redirect"] = "/nginx/" + x_sendfile
+        # nginx does not keep the Vary header of a redirected response, this location adds it back
+        location = "/nginx-vary-accept/" if "Accept" in resp.vary else "/nginx/"
+        resp.headers["X-Accel-Redirect"] = location + x_sendfile.lstrip("/")
         del resp.headers["X-Sendfile"]
     resp.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
     return resp
 
 
+@app.errorhandler(QueueFullError)
+def queue_full(e):
+    response = jsonify(error="Too many images are being processed, please retry later")
+    response.status_code = 503
+    response.headers["Retry-After"] = str(settings.JOB_RETRY_AFTER)
+    return response
+
+
+@app.errorhandler(JobTimeoutError)
+def job_timeout(e):
+    return jsonify(error="Image processing timed out"), 503
+
+
+@app.errorhandler(JobFailedError)
+def job_failed(e):
+    logger.error(f"Image processing failed: {e}")
+    return jsonify(error="Image processing failed"), 500
+
+
+@app.errorhandler(ResourceLimitError)
+def resource_limit_exceeded(e):
+    return jsonify(error="Image too large to process"), 413
+
+
+# Number of bytes needed by filetype to recognize every supported type
+FILE_TYPE_SNIFF_SIZE = 8192
+
+
 class InvalidSize(Exception):
     pass
 
@@ -84,6 +183,10 @@ class InvalidFolderError(Exception):
     pass
 
 
+class InvalidResizeParametersError(Exception):
+    pass
+
+
 def _validate_folder(folder):
     """
     Validate folder parameter to prevent path traversal attacks.
@@ -116,106 +219,24 @@ def _get_size_from_string(size):
     return size
 
 
-def _clear_imagemagick_temp_files():
-    """
-    A bit of a hacky solution to prevent exhausting the cache ImageMagick uses on disk.
-    It works by checking for imagemagick cache files under /tmp/
-    and removes those that are older than settings.MAX_TMP_FILE_AGE in seconds.
-    """
-    imagemagick_temp_files = glob.glob("/tmp/magick-*")
-    for filepath in imagemagick_temp_files:
-        modified = datetime.datetime.strptime(
-            time.ctime(os.path.getmtime(filepath)),
-            "%a %b %d %H:%M:%S %Y",
-        )
-        diff = datetime.datetime.now() - modified
-        seconds = diff.seconds
-        if seconds > settings.MAX_TMP_FILE_AGE:
-            os.remove(filepath)
-
-
-def _get_random_filename():
-    random_string = _generate_random_filename()
-    if settings.NAME_STRATEGY == "randomstr":
-        file_exists = len(glob.glob(f"{settings.FILES_DIR}/{random_string}.*")) > 0
-        if file_exists:
-            return _get_random_filename()
-    return random_string
-
-
-def _generate_random_filename():
-    if settings.NAME_STRATEGY == "uuidv4":
-        return str(uuid.uuid4())
-    if settings.NAME_STRATEGY == "randomstr":
-        return "".join(
-            random.choices(
-                string.ascii_lowercase + string.digits + string.ascii_uppercase, k=5
-            )
-        )
-
-
-def _resize_image(path, width, height):
-    with Image(filename=path) as src:
-        img = src.clone()
-
-    current_aspect_ratio = img.width / img.height
-
-    if not width:
-        width = int(current_aspect_ratio * height)
-
-    if not height:
-        height = int(width / current_aspect_ratio)
-
-    desired_aspect_ratio = width / height
-
-    # Crop the image to fit the desired AR
-    if desired_aspect_ratio > current_aspect_ratio:
-        newheight = int(img.width / desired_aspect_ratio)
-        img.crop(
-            0,
-            int((img.height / 2) - (newheight / 2)),
-            width=img.width,
-            height=newheight,
-        )
-    else:
-        newwidth = int(img.height * desired_aspect_ratio)
-        img.crop(
-            int((img.width / 2) - (newwidth / 2)),
-            0,
-            width=newwidth,
-            height=img.height,
-        )
-
-    @timeout_decorator.timeout(settings.RESIZE_TIMEOUT)
-    def resize(img, width, height):
-        img.sample(width, height)
-
-    try:
-        resize(img, width, height)
-    except timeout_decorator.TimeoutError:
-        pass
-
-    return img
-
-
 @app.route("/liveness", methods=["GET"])
 def liveness():
     return Response(status=200)
 
 
-@app.route("/", methods=["POST"])
-@limiter.limit(
-    "".join(
-        [
-            f"{settings.MAX_UPLOADS_PER_DAY}/day;",
-            f"{settings.MAX_UPLOADS_PER_HOUR}/hour;",
-            f"{settings.MAX_UPLOADS_PER_MINUTE}/minute",
-        ]
-    )
+UPLOAD_LIMITS = "".join(
+    [
+        f"{settings.MAX_UPLOADS_PER_DAY}/day;",
+        f"{settings.MAX_UPLOADS_PER_HOUR}/hour;",
+        f"{settings.MAX_UPLOADS_PER_MINUTE}/minute",
+    ]
 )
+
+
+@app.route("/", methods=["POST"])
+@limiter.limit(UPLOAD_LIMITS)
 def upload_file():
     current_app.logger.info("Upload file")
-    _clear_imagemagick_temp_files()
 
     if "file" not in request.files:
         return jsonify(error="File is missing!"), 400
@@ -229,70 +250,246 @@ def upload_file():
     except InvalidFolderError as e:
         return jsonify(error=str(e)), 400
 
-    # Saving the file to a temporary location
-    random_string = _get_random_filename()
-    current_app.logger.info("Upload file : name generated %s", random_string)
-
-    tmp_filepath = os.path.join("/tmp/", random_string)
-    file.save(tmp_filepath)
-    file.seek(0)
-
-    file_type = filetype.guess(tmp_filepath)
+    # Sniffing the file type from the first bytes only, the upload is then streamed as is
+    with instrumentation.STAGE_DURATION_SECONDS.labels("sniff").time():
+        file_type = filetype.guess(file.stream.read(FILE_TYPE_SNIFF_SIZE))
+    file.stream.seek(0)
     if file_type is None:
         return jsonify(error="File type could not be determined!"), 400
 
-    output_type = settings.OUTPUT_TYPE or file_type.extension
-    base_filename = os.path.basename(tmp_filepath) + f".{output_type}"
+    error = None
 
-    # Include folder in output path if specified
-    if folder:
-        output_filename = f"{folder}/{base_filename}"
-    else:
-        output_filename = base_filename
+    try:
+        output_filename = _store_upload(file.stream, file_type, folder)
+    except (MissingDelegateError, InvalidFileTypeError):
+        error = "Invalid Filetype"
 
-    error = None
+    if error:
+        return jsonify(error=error), 400
+    current_app.logger.info("Upload file : returning filename %s", output_filename)
+    return jsonify(filename=output_filename)
+
+
+@app.route("/uploads", methods=["POST"])
+@limiter.limit(UPLOAD_LIMITS)
+def create_direct_upload():
+    """
+    First step of a direct upload: returns the URL and the form fields the client posts
+    the file to, straight to the storage provider. The upload is then finalized with
+    POST /uploads/<token>.
+    """
+    if not _are_direct_uploads_enabled():
+        return jsonify(error="Direct uploads are disabled"), 404
+
+    content_type = request.form.get("content_type", "")
+    if content_type not in settings.ALLOWED_MIME_FILE_TYPES:
+        return jsonify(error="Invalid Filetype"), 400
 
+    max_size = settings.MAX_SIZE_MB * 1024 * 1024
     try:
-        if file_type.mime not in settings.ALLOWED_MIME_FILE_TYPES:
-            raise InvalidFileTypeError
-        if storage.exists(output_filename):
-            raise CollisionError
-        if file_type.mime not in settings.RESIZABLE_MIME_FILE_TYPES:
-            # We need a BufferedReader to be able to save the file to the storage provider
-            with open(tmp_filepath, "rb") as file:
-                storage.save(file, output_filename)
-            os.remove(tmp_filepath)
-        else:
-            converted_file_path = f"{tmp_filepath}.{output_type}"
-
-            with Image(filename=tmp_filepath) as img:
-                img.strip()
-                if output_type not in ["gif"]:
-                    with img.sequence[0] as first_frame:
-                        with Image(image=first_frame) as first_frame_img:
-                            with first_frame_img.convert(output_type) as converted:
-                                converted.save(filename=converted_file_path)
-                else:
-                    with img.convert(output_type) as converted:
-                        converted.save(filename=converted_file_path)
-
-            with open(converted_file_path, "rb") as converted_file:
-                storage.save(converted_file, output_filename)
-            # After saving the converted file on the storage provider, we can delete the temporary file from the filesystem
-            os.remove(converted_file_path)
+        size = int(request.form.get("size", ""))
+    except ValueError:
+        size = 0
+    if not 0 < size <= max_size:
+        return jsonify(error=f"size must be between 1 and {max_size} bytes"), 400
+
+    try:
+        folder = _validate_folder(request.form.get("folder", ""))
+    except InvalidFolderError as e:
+        return jsonify(error=str(e)), 400
+
+    token = uuid.uuid4().hex
+    url, fields = storage.create_upload(token, content_type, size, folder)
+    current_app.logger.info("Direct upload : created %s", token)
+    return jsonify(
+        token=token,
+        url=url,
+        fields=fields,
+        expires_in=settings.DIRECT_UPLOAD_EXPIRATION,
+    )
+
+
+@app.route("/uploads/<token>", methods=["POST"])
+@limiter.exempt
+def finalize_direct_upload(token):
+    """
+    Second step of a direct upload: the uploaded file is checked, converted and stored
+    as if it had been posted to POST /, then the upload is removed
+    """
+    if not _are_direct_uploads_enabled():
+        return jsonify(error="Direct uploads are disabled"), 404
+
+    if not re.match(r"^[0-9a-f]{32}$", token):
+        return jsonify(error="Upload not found!"), 404
 
+    error = None
+    try:
+        # Only the first bytes are fetched to sniff the file type, the content is downloaded if it has to be processed
+        head, folder = storage.peek_upload(token, FILE_TYPE_SNIFF_SIZE)
+        folder = _validate_folder(folder)
+        with instrumentation.STAGE_DURATION_SECONDS.labels("sniff").time():
+            file_type = filetype.guess(head)
+        if file_type is None:
+            error = "File type could not be determined!"
+        elif _is_stored_as_is(file_type):
+            output_filename = _save_under_new_name(
+                None,
+                folder,
+                settings.OUTPUT_TYPE or file_type.extension,
+                save=lambda filename: storage.promote_upload(token, filename),
+            )
+        else:
+            with storage.open_upload(token) as content:
+                output_filename = _store_upload(content, file_type, folder)
+    except FileNotFoundError:
+        return jsonify(error="Upload not found!"), 404
+    except InvalidFolderError as e:
+        error = str(e)
     except (MissingDelegateError, InvalidFileTypeError):
         error = "Invalid Filetype"
-    finally:
-        if os.path.exists(tmp_filepath):
-            os.remove(tmp_filepath)
+
+    # Transient failures (e.g. a full job queue) raise before this point:
+    # the upload is kept so it can be finalized again
+    storage.delete_upload(token)
 
     if error:
         return jsonify(error=error), 400
-    current_app.logger.info("Upload file : returning filename %s", output_filename)
+    current_app.logger.info("Direct upload : returning filename %s", output_filename)
     return jsonify(filename=output_filename)
 
 
+def _are_direct_uploads_enabled():
+    return settings.DIRECT_UPLOADS and isinstance(storage, DirectUploadStorage)
+
+
+def _is_stored_as_is(file_type):
+    """
+    Returns True when a direct upload of `file_type` is copied by the storage provider without being downloaded:
+    files that are not images are stored untouched, unless their content is needed to deduplicate or name them
+    """
+    return (
+        file_type.mime in settings.ALLOWED_MIME_FILE_TYPES
+        and file_type.mime not in settings.RESIZABLE_MIME_FILE_TYPES
+        and deduplication_index is None
+        and not names.is_deterministic()
+    )
+
+
+def _store_upload(stream, file_type, folder):
+    """
+    Stores the uploaded `stream`, of type `file_type`, in `folder`. Images are converted beforehand.
+    Returns the name of the stored file, which is the name of the existing copy if the content is deduplicated.
+    Raises InvalidFileTypeError or MissingDelegateError if the file cannot be accepted.
+    """
+    output_type = settings.OUTPUT_TYPE or file_type.extension
+
+    if file_type.mime not in settings.ALLOWED_MIME_FILE_TYPES:
+        raise InvalidFileTypeError
+
+    if deduplication_index is not None:
+        # The upload is hashed before being converted, so a known content is neither converted nor stored again
+        with instrumentation.STAGE_DURATION_SECONDS.labels("hash").time():
+            digest = names.hash_content(stream)
+        existing_filename = deduplication_index.acquire(digest, folder, output_type)
+        if existing_filename is not None:
+            instrumentation.DEDUPLICATED_UPLOADS.inc()
+            current_app.logger.info(
+                "Upload file : content already stored as %s", existing_filename
+            )
+            return existing_filename
+
+    if file_type.mime not in settings.RESIZABLE_MIME_FILE_TYPES:
+        # Files that are not images are handed over to the storage provider untouched
+        output_filename = _save_under_new_name(stream, folder, output_type)
+    else:
+        converted = job_pool.run(
+            images.convert_image,
+            stream.read(),
+            output_type,
+            timeout=settings.JOB_TIMEOUT,
+        )
+        output_filename = _save_under_new_name(
+            io.BytesIO(converted), folder, output_type
+        )
+
+    if deduplication_index is not None:
+        registered_filename = deduplication_index.register(
+            digest, folder, output_type, output_filename
+        )
+        if registered_filename != output_filename:
+            # The same content was uploaded concurrently, only its copy is kept
+            storage.delete(output_filename)
+            instrumentation.DEDUPLICATED_UPLOADS.inc()
+            return registered_filename
+
+    # The configured variants are rendered in the background, from the converted image
+    if settings.EAGER_RESIZE_SIZES and file_type.mime in settings.RESIZABLE_MIME_FILE_TYPES:
+        _submit_eager_variants(converted, output_filename)
+
+    return output_filename
+
+
+def _save_under_new_name(content, folder, extension, save=None):
+    """
+    Saves `content` under a newly generated name, and returns the name.
+    The storage provider reserves the name atomically, so it is never checked beforehand.
+    `save(filename)` replaces the exclusive save of `content`, which is then None, by another exclusive write.
+    """
+    if save is None:
+        def save(filename):
+            storage.save(content, filename, exclusive=True)
+
+    for _ in range(names.MAX_ATTEMPTS):
+        filename = f"{names.generate_name(content)}.{extension}"
+        # Include folder in output path if specified
+        if folder:
+            filename = f"{folder}/{filename}"
+        current_app.logger.info("Upload file : name generated %s", filename)
+
+        try:
+            with instrumentation.STAGE_DURATION_SECONDS.labels("storage_save").time():
+                save(filename)
+            return filename
+        except FileExistsError:
+            if names.is_deterministic():
+                # The very same content is already stored under this name
+                return filename
+            if content is not None:
+                content.seek(0)
+
+    raise CollisionError
+
+
+def _submit_eager_variants(converted, filename):
+    sizes = [
+        tuple(_get_size_from_string(value) for value in size.split("x"))
+        for size in settings.EAGER_RESIZE_SIZES
+    ]
+    try:
+        future = job_pool.submit(
+            images.render_variants,
+            converted,
+            filename,
+            sizes,
+            settings.DEFAULT_RESIZE_PROFILE,
+            # Clients negotiating WebP or AVIF are served variants of their own
+            _get_negotiable_output_types(mimetypes.guess_type(filename)[0]),
+            timeout=settings.JOB_TIMEOUT,
+        )
+    except QueueFullError:
+        # Counted as rejected in imgpush_jobs
+        logger.warning("Job queue is full, skipping the eager variants of %s", filename)
+        return
+
+    def log_failure(future):
+        # The job pool counts the failures and timeouts in imgpush_jobs, nobody waits for the result
+        exception = future.exception()
+        if exception is not None:
+            logger.error("Eager variants of %s failed: %r", filename, exception, exc_info=exception)
+
+    future.add_done_callback(log_failure)
+
+
 @app.route("/<path:filename>", methods=["DELETE"])
 @limiter.exempt
 def delete_image(filename):
@@ -301,14 +498,18 @@ def delete_image(filename):
     if (filename) and (re.match(r"^[\w\d\-/]+\.[\w\d]+$", filename)):
         # Additional check: no path traversal
         if ".." not in filename:
-            storage.delete(filename)
+            # A deduplicated file is only deleted along with its last reference
+            if deduplication_index is None or deduplication_index.release(filename):
+                storage.delete(filename)
+                memory_cache.invalidate(filename)
+                resized_image_cache.invalidate(filename)
     return Response(status=200)
 
 
 @app.route("/<path:filename>")
 @limiter.exempt
 def get_file(filename):
-    if not storage.exists(filename):
+    if _is_hidden(filename):
         return jsonify(error="File not found!"), 404
 
     file_type = mimetypes.guess_type(filename)
@@ -320,72 +521,382 @@ def get_file(filename):
 
     width = request.args.get("w", "")
     height = request.args.get("h", "")
+    profile = request.args.get("profile", settings.DEFAULT_RESIZE_PROFILE)
 
-    # If the file type is resizable and the user is asking for a resized version
-    # we first check if it is cached before downloading the file
-    if mime_type in settings.RESIZABLE_MIME_FILE_TYPES and (width or height):
+    is_resize_requested = mime_type in settings.RESIZABLE_MIME_FILE_TYPES and (
+        width or height
+    )
+    output_type = None
+    variant = ""
+    if is_resize_requested:
         try:
-            width = _get_size_from_string(width)
-            height = _get_size_from_string(height)
-        except InvalidSize:
-            return (
-                jsonify(error=f"size value must be one of {settings.VALID_SIZES}"),
-                400,
+            width, height = _validate_resize_parameters(width, height, profile)
+        except InvalidResizeParametersError as e:
+            return jsonify(error=str(e)), 400
+        output_type = _negotiate_output_type(mime_type)
+        mime_type = f"image/{output_type}" if output_type else mime_type
+        variant = _get_variant_key(width, height, profile, output_type)
+
+    # Small hot files are served straight from memory, without reaching the storage provider
+    response = _send_from_memory(filename, variant, mime_type)
+    if response is not None:
+        apply_cache(response)
+        _apply_vary(response, is_resize_requested)
+        return response
+
+    # The existence of the file is not checked beforehand: cached variants are served
+    # without reaching the storage provider, and a missing file costs a single round trip
+    try:
+        # If the file type is resizable and the user is asking for a resized version
+        # we first check if it is cached before downloading the file
+        if is_resize_requested:
+            response = get_or_create_resized_image(
+                filename, width, height, profile, output_type
             )
+        # If the file type is not resizable, or the user is not asking for a resized version
+        # We stream the file directly from the storage provider
+        else:
+            response = _send_stored_file(filename, mime_type)
+    except FileNotFoundError:
+        return jsonify(error="File not found!"), 404
 
-        response = get_or_create_resized_image(filename, width, height)
-        apply_cache(response)
+    apply_cache(response)
+    _apply_vary(response, is_resize_requested)
+    return response
+
+
+def _validate_resize_parameters(width, height, profile):
+    """
+    Returns the requested width and height as integers, or "" when they are not set.
+    Raises InvalidResizeParametersError if a size or the profile is not allowed.
+    """
+    try:
+        width = _get_size_from_string(width)
+        height = _get_size_from_string(height)
+    except InvalidSize:
+        raise InvalidResizeParametersError(
+            f"size value must be one of {settings.VALID_SIZES}"
+        )
+    if profile not in settings.RESIZE_PROFILES:
+        raise InvalidResizeParametersError(
+            f"profile value must be one of {list(settings.RESIZE_PROFILES)}"
+        )
+    return width, height
+
+
+def _send_from_memory(filename, variant, mime_type):
+    """
+    Returns a response serving the `variant` of `filename` from the memory cache, or None if it is not cached
+    """
+    cached = memory_cache.get(filename, variant)
+    if memory_cache.max_size:
+        instrumentation.CACHE_LOOKUPS.labels(
+            "memory", "miss" if cached is None else "hit"
+        ).inc()
+    if cached is None:
+        return None
+
+    response = _not_modified(cached.etag, cached.last_modified)
+    if response is None:
+        response = Response(cached.content, mimetype=mime_type)
+        _apply_validators(response, cached.etag, cached.last_modified)
+    return response
+
+
+def _is_hidden(filename):
+    # Temporary files, indexes and pending direct uploads are kept under names starting with a dot,
+    # they are never served
+    return any(part.startswith(".") for part in filename.split("/"))
+
+
+def _get_negotiable_output_types(mime_type):
+    """
+    Returns the negotiated output types a file of `mime_type` may be served in, by order of preference.
+    The types coming after the stored format are never picked, as the stored format is preferred to them,
+    and animated GIFs are never converted, as only their first frame would remain.
+    """
+    if mime_type == "image/gif":
+        return []
+
+    output_types = []
+    for output_type in negotiated_output_types:
+        if f"image/{output_type}" == mime_type:
+            break
+        output_types.append(output_type)
+    return output_types
+
+
+def _negotiate_output_type(mime_type):
+    """
+    Returns the first of the negotiated output types the client accepts, or None
+    if the file should be served in its stored format
+    """
+    # The types must be listed explicitly, as most clients accept */* but only some decode WebP or AVIF
+    accepted = [value for value, quality in request.accept_mimetypes if quality > 0]
+    for output_type in _get_negotiable_output_types(mime_type):
+        if f"image/{output_type}" in accepted:
+            return output_type
+    return None
+
+
+def _apply_vary(response, is_resize_requested):
+    # Shared caches must not serve a variant negotiated for a client to another one
+    if is_resize_requested and negotiated_output_types:
+        response.vary.add("Accept")
+
+
+def _get_variant_key(width, height, profile, output_type=None):
+    variant = f"{width}x{height}_{profile}"
+    if output_type is not None:
+        variant += f".{output_type}"
+    return variant
+
+
+def _send_stored_file(filename, mime_type):
+    # Files stored on S3 can be fetched by nginx or by the client, which frees the worker right away
+    if settings.S3_SERVING_MODE != "stream":
+        url = storage.get_url(filename)
+        if url is not None:
+            return _send_url(url, mime_type)
+
+    # Single ranges are forwarded to the storage provider, multiple ranges are ignored
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) != 1:
+        byte_range = None
+
+    try:
+        with instrumentation.STAGE_DURATION_SECONDS.labels("storage_open").time():
+            stored_file = storage.open(
+                filename,
+                byte_range,
+                request.headers.get("If-None-Match"),
+                request.if_modified_since,
+            )
+    except InvalidRangeError:
+        return Response(status=416)
+    except NotModifiedError as e:
+        # The client's copy is still valid, the content was not read
+        response = Response(status=304)
+        _apply_validators(response, e.etag, e.last_modified)
         return response
 
-    # If the file type is not resizable, or the user is not asking for a resized version
-    # We serve the file directly
-    tmp_filepath, delete_temporary_file = storage.get(filename)
+    # Files on the local filesystem are sent by nginx, which handles ranges itself
+    if stored_file.path is not None and (
+        settings.NGINX_ACCEL_REDIRECT or not memory_cache.accepts(stored_file.size)
+    ):
+        stored_file.close()
+        response = send_file(
+            stored_file.path,
+            mimetype=mime_type,
+            conditional=not settings.NGINX_ACCEL_REDIRECT,
+            etag=False,
+        )
+        _apply_validators(response, stored_file.etag, stored_file.last_modified)
+        return response
+
+    # Small files are read at once, and kept in memory for the next requests
+    if stored_file.content_range is None and memory_cache.accepts(
+        stored_file.content_length
+    ):
+        content = stored_file.read()
+        memory_cache.put(
+            filename, content, etag=stored_file.etag, last_modified=stored_file.last_modified
+        )
+        response = Response(content, mimetype=mime_type)
+    else:
+        response = Response(
+            stored_file.iter_chunks(), mimetype=mime_type, direct_passthrough=True
+        )
+        response.content_length = stored_file.content_length
+        if stored_file.content_range is not None:
+            start, stop = stored_file.content_range
+            response.status_code = 206
+            response.content_range = ContentRange("bytes", start, stop, stored_file.size)
+
+    response.accept_ranges = "bytes"
+    _apply_validators(response, stored_file.etag, stored_file.last_modified)
+    return response
 
-    response = send_file(tmp_filepath)
-    delete_temporary_file()
 
-    apply_cache(response)
+def _send_url(url, mime_type):
+    """
+    Returns a response sending the file at the presigned `url`, according to S3_SERVING_MODE
+    """
+    if settings.S3_SERVING_MODE == "redirect":
+        return redirect(url)
+
+    # nginx fetches the file from S3 and streams it to the client, see the /nginx-s3/ location
+    parsed_url = urlsplit(url)
+    response = Response(mimetype=mime_type)
+    response.headers["X-Accel-Redirect"] = (
+        f"/nginx-s3/{parsed_url.scheme}/{parsed_url.netloc}{parsed_url.path}?{parsed_url.query}"
+    )
     return response
 
 
+def _cache_in_memory(path, filename, variant="", etag=None, last_modified=None):
+    """
+    Keeps the content of the file at `path` in the memory cache, if it is small enough.
+    Returns the content, or None if the file is too large to be cached, or is sent by nginx.
+    """
+    if settings.NGINX_ACCEL_REDIRECT or not memory_cache.accepts(os.path.getsize(path)):
+        return None
+
+    with open(path, "rb") as f:
+        content = f.read()
+    memory_cache.put(filename, content, variant, etag, last_modified)
+    return content
+
+
+def _not_modified(etag, last_modified):
+    """
+    Returns a 304 response if the copy held by the client is still up to date, None otherwise
+    """
+    if not is_not_modified(
+        etag,
+        last_modified,
+        request.headers.get("If-None-Match"),
+        request.if_modified_since,
+    ):
+        return None
+    response = Response(status=304)
+    _apply_validators(response, etag, last_modified)
+    return response
+
+
+def _apply_validators(response, etag, last_modified):
+    if etag:
+        response.headers["ETag"] = etag
+    if last_modified:
+        response.last_modified = last_modified
+
+
 def apply_cache(response):
-    response.headers["Cache-Control"] = f"public, max-age={60*60}"
-    response.headers["Expires"] = f"{60*60}"
+    # send_file marks its responses no-cache, which would make clients revalidate on every request
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = settings.CACHE_CONTROL_MAX_AGE
+    # Names never change once written, so clients can skip revalidating until the file expires
+    response.cache_control.immutable = settings.CACHE_CONTROL_IMMUTABLE
+    response.expires = time.time() + settings.CACHE_CONTROL_MAX_AGE
 
 
-def get_or_create_resized_image(filename, width, height):
-    filename_without_extension, extension_with_dot = os.path.splitext(filename)
-    extension = extension_with_dot[1:]  # remove the dot from the extension
-    dimensions = f"{width}x{height}"
-    resized_filename = f"{filename_without_extension}_{dimensions}.{extension}"
+def _read_source_variant(filename, width, height, profile):
+    """
+    Returns the content of the cached variant of `filename` to derive `width`x`height` from,
+    or None if it should be resized from the original
+    """
+    source_path = resized_image_cache.find_source(filename, width, height, profile)
+    if source_path is None:
+        return None
+    try:
+        # The variant is read right away, as it could be evicted before the resize starts
+        with open(source_path, "rb") as source_file:
+            return source_file.read()
+    except FileNotFoundError:
+        return None
 
-    resized_path = os.path.join(settings.CACHE_DIR, resized_filename)
 
-    # If the resized version is cached, we return it
-    if os.path.isfile(resized_path) and (width or height):
-        return send_from_directory(settings.CACHE_DIR, resized_filename)
-    # If the resized version is not cached, we generate it and return it
-    else:
-        tmp_filepath, delete_temporary_file = storage.get(filename)
+def _read_original(filename):
+    """
+    Returns the original `filename` in a form the resize job can decode: local files are decoded
+    where they are, remote ones from memory, never from a temporary copy
+    """
+    with instrumentation.STAGE_DURATION_SECONDS.labels("storage_get").time():
+        stored_file = storage.open(filename)
+        if stored_file.path is not None:
+            stored_file.close()
+            return stored_file.path
+        return stored_file.read()
 
-        resized_image = _resize_image(tmp_filepath, width, height)
-        resized_image.strip()
 
-        # Create cache subdirectory if needed (for folder-based uploads)
-        resized_dir = os.path.dirname(resized_path)
-        if resized_dir and not os.path.exists(resized_dir):
-            os.makedirs(resized_dir, exist_ok=True)
+def _render_resized_image(path, filename, width, height, profile):
+    """
+    Writes the variant `width`x`height` of `filename` to `path`, for the resized images cache.
+    Returns its (width, height, cropped) when it was resized from the original, None otherwise.
+    """
+    # A larger cached variant is much cheaper to fetch and decode than the original
+    source = _read_source_variant(filename, width, height, profile)
+    derived = source is not None
+    instrumentation.CACHE_LOOKUPS.labels(
+        "source_variant", "hit" if derived else "miss"
+    ).inc()
+
+    if not derived:
+        source = _read_original(filename)
+    resized_width, resized_height = job_pool.run(
+        images.resize_image,
+        source,
+        path,
+        width,
+        height,
+        profile,
+        timeout=settings.RESIZE_TIMEOUT,
+    )
 
-        resized_image.save(filename=resized_path)
-        resized_image.close()
+    # Only the variants resized from the original are used to derive other sizes,
+    # so that a variant is never more than one resize away from the original
+    if derived:
+        return None
+    return resized_width, resized_height, bool(width and height)
 
-        delete_temporary_file()
-        return send_file(resized_path)
+
+def get_or_create_resized_image(filename, width, height, profile, output_type=None):
+    resized_filename = images.get_resized_filename(
+        filename, width, height, profile, output_type
+    )
+
+    resized_path = resized_image_cache.lookup(resized_filename, filename)
+    instrumentation.CACHE_LOOKUPS.labels(
+        "resized", "miss" if resized_path is None else "hit"
+    ).inc()
+
+    # If the resized version is not cached, we generate it
+    if resized_path is None:
+        resized_path = resized_image_cache.render(
+            resized_filename,
+            lambda path: _render_resized_image(path, filename, width, height, profile),
+            filename,
+            profile,
+        )
+
+    # The validators of a variant are those of its file in the cache, which is never rewritten
+    etag, last_modified = get_validators(os.stat(resized_path))
+    response = _not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    mime_type = (
+        f"image/{output_type}" if output_type else mimetypes.guess_type(filename)[0]
+    )
+    content = _cache_in_memory(
+        resized_path,
+        filename,
+        _get_variant_key(width, height, profile, output_type),
+        etag,
+        last_modified,
+    )
+    if content is not None:
+        response = Response(content, mimetype=mime_type)
+    else:
+        response = send_from_directory(
+            settings.CACHE_DIR,
+            resized_filename,
+            mimetype=mime_type,
+            conditional=not settings.NGINX_ACCEL_REDIRECT,
+            etag=False,
+        )
+    _apply_validators(response, etag, last_modified)
+    return response
 
 
 @app.route("/metrics", methods=["GET"])
 def metrics():
-    return storage.get_metrics()
+    return (
+        storage.get_metrics()
+        + resized_image_cache.get_metrics()
+        + instrumentation.generate_metrics()
+    )
 
 @app.route("/info", methods=["GET"])
 def info():
@@ -396,7 +907,8 @@ def info():
         },
         "storage": {
             "type": storage.__class__.__name__,
-        }
+        },
+        "cache": resized_image_cache.get_stats(),
     })
 
 if __name__ == "__main__":
@@ -0,0 +1,534 @@
+import atexit
+import collections
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+# Resized variants share this many lock files, so that the lock directory stays bounded
+LOCK_STRIPES = 1024
+
+
+@contextlib.contextmanager
+def single_flight(key, blocking=True):
+    """
+    Holds an exclusive lock on `key` for the duration of the block, and yields True.
+    Unless `blocking`, yields False right away when the lock is held elsewhere, and the block runs unlocked.
+    The lock is a flock on a file under CACHE_DIR, so it is honored by the other threads
+    of the worker as well as by the other gunicorn workers.
+    """
+    lock_dir = os.path.join(settings.CACHE_DIR, ".locks")
+    os.makedirs(lock_dir, exist_ok=True)
+
+    stripe = int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16) % LOCK_STRIPES
+    # Every call opens its own file description, which is what flock locks are bound to
+    with open(os.path.join(lock_dir, f"{stripe}.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        # The lock is released when the file is closed
+        yield True
+
+
+def write_atomically(path, write):
+    """
+    Calls `write` with a temporary path, then moves the written file to `path`.
+    Readers either see the complete file, or no file at all. Returns what `write` returned.
+    """
+    tmp_dir = os.path.join(settings.CACHE_DIR, ".tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    # The extension is kept, as ImageMagick picks the output format from it
+    _, extension = os.path.splitext(path)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=extension)
+    os.close(fd)
+
+    try:
+        result = write(tmp_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return result
+
+
+class ResizedImageCache:
+    """
+    Keeps track of the resized variants stored in CACHE_DIR, and evicts the least recently used
+    ones once CACHE_MAX_SIZE_MB or CACHE_MAX_ENTRIES is exceeded.
+
+    The index is a SQLite database next to the variants, shared by all the workers.
+    It holds the size and the last access time of each variant, as well as running totals,
+    so the budget is enforced without ever walking CACHE_DIR.
+
+    The variants rendered from an original are also indexed with their dimensions,
+    so that smaller sizes can be derived from them instead of the original (see `find_source`).
+
+    Hits, misses and accesses are buffered by each worker, and written to the index together
+    every FLUSH_INTERVAL seconds or FLUSH_ENTRIES accesses, rather than in a transaction per hit.
+    """
+
+    STATS = ["hits", "misses", "evictions", "size", "entries"]
+    FLUSH_INTERVAL = 5
+    FLUSH_ENTRIES = 100
+
+    def __init__(self, directory=None):
+        self.directory = directory or settings.CACHE_DIR
+        self.index_path = os.path.join(self.directory, ".index.sqlite3")
+        self.max_size = settings.CACHE_MAX_SIZE_MB * 1024 * 1024
+        self.max_entries = settings.CACHE_MAX_ENTRIES
+        self.min_source_scale = settings.RESIZE_FROM_VARIANT_MIN_SCALE
+        self._local = threading.local()
+        self._buffer_lock = threading.Lock()
+        self._reset_buffer()
+        atexit.register(self.flush)
+
+    def lookup(self, name, original=None):
+        """
+        Returns the path of the cached variant `name` of the file `original`, or None if it is not cached yet
+        """
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            self._record("misses")
+            return None
+
+        self._record("hits", name, original)
+        return path
+
+    def render(self, name, render, original=None, profile=None, blocking=True):
+        """
+        Renders the variant `name` by calling `render` with the path to write to,
+        unless another request rendered it in the meantime. Returns the path of the variant.
+        Unless `blocking`, returns None right away when another request is rendering it.
+
+        When `render` resized the `original` file itself, it returns the (width, height, cropped)
+        of the variant, which is then indexed as a possible source for smaller sizes
+        of the same resize `profile`.
+        """
+        path = os.path.join(self.directory, name)
+
+        # Only one request renders a given variant, the others wait for it and serve the cached file
+        with single_flight(name, blocking) as locked:
+            # The variant may have been rendered while we were waiting for the lock
+            if os.path.isfile(path):
+                return path
+            if not locked:
+                return None
+            dimensions = write_atomically(path, render)
+
+        connection = self._connection()
+        with self._transaction(connection):
+            self._insert(connection, name, os.path.getsize(path), original)
+            if original is not None and dimensions is not None:
+                width, height, cropped = dimensions
+                connection.execute(
+                    "INSERT OR REPLACE INTO variants "
+                    "(name, original, profile, width, height, cropped) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, original, profile, width, height, cropped),
+                )
+            self._evict(connection)
+        return path
+
+    def find_source(self, original, width, height, profile=None):
+        """
+        Returns the path of the smallest cached variant of `original` the size `width`x`height`
+        can be derived from with the resize `profile`, or None if the original should be resized instead.
+
+        A variant qualifies when it covers the same part of the original as the requested size,
+        i.e. it was not cropped, or cropped to the same aspect ratio, and it is at least
+        RESIZE_FROM_VARIANT_MIN_SCALE times larger once cropped, so that the quality stays
+        close to a resize of the original.
+        """
+        if not self.min_source_scale:
+            return None
+
+        connection = self._connection()
+        variants = connection.execute(
+            "SELECT name, width, height, cropped FROM variants "
+            "WHERE original = ? AND profile IS ? ORDER BY width * height",
+            (original, profile),
+        ).fetchall()
+
+        for name, variant_width, variant_height, cropped in variants:
+            if width and height:
+                if cropped and variant_width * height != variant_height * width:
+                    continue
+                # Size of the variant once cropped to the requested aspect ratio
+                scale = min(variant_width / width, variant_height / height)
+            elif cropped:
+                continue
+            elif width:
+                scale = variant_width / width
+            else:
+                scale = variant_height / height
+
+            if scale < self.min_source_scale:
+                continue
+
+            path = os.path.join(self.directory, name)
+            # The variant may have been evicted by another worker
+            if os.path.isfile(path):
+                self._record(None, name, original)
+                return path
+        return None
+
+    def invalidate(self, filename):
+        """
+        Removes all the cached variants of `filename`
+        """
+        filename_without_extension, _ = os.path.splitext(filename)
+        # Variants indexed before their original was recorded are recognized by their name,
+        # i.e. the name of the original without extension, followed by the size and the profile
+        legacy_name = re.compile(
+            re.escape(filename_without_extension)
+            + r"_\d*x\d*(_({}))?\.[^./]+".format(
+                "|".join(re.escape(profile) for profile in settings.RESIZE_PROFILES)
+            )
+        )
+        connection = self._connection()
+        with self._transaction(connection):
+            variants = connection.execute(
+                "SELECT name, size, original FROM entries "
+                "WHERE original = ? OR (original IS NULL AND name > ? AND name < ?)",
+                # The names starting with `{filename_without_extension}_`, "`" being the character after "_"
+                (filename, f"{filename_without_extension}_", f"{filename_without_extension}`"),
+            ).fetchall()
+            for name, size, original in variants:
+                if original is not None or legacy_name.fullmatch(name):
+                    self._remove(connection, name, size)
+
+    def flush(self):
+        """
+        Writes the hits, misses and accesses buffered by this worker to the index
+        """
+        with self._buffer_lock:
+            if self._buffer_pid != os.getpid():
+                # Buffered by the parent process before the fork, it writes them itself
+                self._reset_buffer()
+            counts, accessed = self._counts, self._accessed
+            self._reset_buffer()
+        if not accessed and not any(counts.values()):
+            return
+
+        connection = self._connection()
+        with self._transaction(connection):
+            for name, value in counts.items():
+                if value:
+                    self._increment(connection, name, value)
+            for name, (accessed_at, original) in accessed.items():
+                updated = connection.execute(
+                    "UPDATE entries SET accessed = MAX(accessed, ?) WHERE name = ?",
+                    (accessed_at, name),
+                ).rowcount
+                path = os.path.join(self.directory, name)
+                if not updated and os.path.isfile(path):
+                    # The variant was written before the index existed
+                    self._insert(connection, name, os.path.getsize(path), original)
+
+    def get_stats(self):
+        self.flush()
+        connection = self._connection()
+        stats = dict(connection.execute("SELECT name, value FROM stats"))
+        stats = {name: stats.get(name, 0) for name in self.STATS}
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0
+        return stats
+
+    def get_metrics(self):
+        """
+        Returns a Prometheus formatted string with the hit ratio, the size and the evictions of the cache
+        """
+        stats = self.get_stats()
+        labels = f'service="imgpush", directory="{self.directory}"'
+
+        metrics_str = ""
+        metrics_str += f"resized_cache_hits{{{labels}}} {stats['hits']}\n"
+        metrics_str += f"resized_cache_misses{{{labels}}} {stats['misses']}\n"
+        metrics_str += f"resized_cache_hit_ratio{{{labels}}} {stats['hit_ratio']}\n"
+        metrics_str += f"resized_cache_evictions{{{labels}}} {stats['evictions']}\n"
+        metrics_str += f"resized_cache_size_in_bytes{{{labels}}} {stats['size']}\n"
+        metrics_str += f"resized_cache_entries{{{labels}}} {stats['entries']}\n"
+        return metrics_str
+
+    def _connection(self):
+        # SQLite connections can neither be shared between threads, nor survive a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.index_path, timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._create_index(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _record(self, stat, name=None, original=None):
+        """
+        Buffers a hit or a miss (`stat`), and the access to the variant `name` of `original`
+        """
+        with self._buffer_lock:
+            if self._buffer_pid != os.getpid():
+                self._reset_buffer()
+            if stat is not None:
+                self._counts[stat] += 1
+            if name is not None:
+                self._accessed[name] = (time.time(), original)
+            due = (
+                len(self._accessed) >= self.FLUSH_ENTRIES
+                or time.monotonic() - self._flushed_at > self.FLUSH_INTERVAL
+            )
+        if due:
+            self.flush()
+
+    def _reset_buffer(self):
+        self._counts = {"hits": 0, "misses": 0}
+        # name -> (last access timestamp, original)
+        self._accessed = {}
+        self._flushed_at = time.monotonic()
+        self._buffer_pid = os.getpid()
+
+    @contextlib.contextmanager
+    def _transaction(self, connection):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _create_index(self, connection):
+        with self._transaction(connection):
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "name TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            # The original of each variant was not recorded in the first versions of the index
+            columns = [column[1] for column in connection.execute("PRAGMA table_info(entries)")]
+            if "original" not in columns:
+                connection.execute("ALTER TABLE entries ADD COLUMN original TEXT")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_original ON entries (original)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS variants ("
+                "name TEXT PRIMARY KEY, original TEXT NOT NULL, profile TEXT, "
+                "width INTEGER NOT NULL, height INTEGER NOT NULL, cropped INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS variants_original ON variants (original)"
+            )
+            initialized = connection.execute(
+                "SELECT 1 FROM stats WHERE name = 'initialized'"
+            ).fetchone()
+            if not initialized:
+                self._adopt_existing_variants(connection)
+                self._increment(connection, "initialized")
+
+    def _adopt_existing_variants(self, connection):
+        """
+        Indexes the variants written before the index was created. This only happens once.
+        """
+        logger.info(f"Indexing the existing resized images in {self.directory}")
+        for root, directories, filenames in os.walk(self.directory):
+            # Skip the locks, temporary files and the index itself
+            directories[:] = [d for d in directories if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory)
+                self._insert(connection, name, os.path.getsize(path))
+
+    def _insert(self, connection, name, size, original=None):
+        previous = connection.execute(
+            "SELECT size FROM entries WHERE name = ?", (name,)
+        ).fetchone()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (name, size, accessed, original) VALUES (?, ?, ?, ?)",
+            (name, size, time.time(), original),
+        )
+        if previous:
+            self._increment(connection, "size", size - previous[0])
+        else:
+            self._increment(connection, "size", size)
+            self._increment(connection, "entries")
+
+    def _evict(self, connection):
+        stats = dict(connection.execute("SELECT name, value FROM stats"))
+        size, entries = stats.get("size", 0), stats.get("entries", 0)
+
+        def over_budget():
+            return (self.max_size and size > self.max_size) or (
+                self.max_entries and entries > self.max_entries
+            )
+
+        while over_budget():
+            oldest = connection.execute(
+                "SELECT name, size FROM entries ORDER BY accessed LIMIT 100"
+            ).fetchall()
+            if not oldest:
+                return
+            for name, entry_size in oldest:
+                if not over_budget():
+                    break
+                self._remove(connection, name, entry_size)
+                size -= entry_size
+                entries -= 1
+                self._increment(connection, "evictions")
+
+    def _remove(self, connection, name, size):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+        connection.execute("DELETE FROM entries WHERE name = ?", (name,))
+        connection.execute("DELETE FROM variants WHERE name = ?", (name,))
+        self._increment(connection, "size", -size)
+        self._increment(connection, "entries", -1)
+
+    def _increment(self, connection, name, value=1):
+        connection.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+
+# Content of a file kept in the memory cache, with the validators it is served with
+CachedContent = collections.namedtuple("CachedContent", ["content", "etag", "last_modified"])
+
+
+class MemoryCache:
+    """
+    In-process LRU cache holding the content of small files, bounded by MEMORY_CACHE_SIZE_MB.
+    Entries are keyed by filename and variant (e.g. "320x240_fast", or "" for the original).
+
+    Each worker has its own cache. Entries expire after MEMORY_CACHE_TTL seconds,
+    so that a file deleted through another worker is not served for long.
+    """
+
+    def __init__(self):
+        self.max_size = settings.MEMORY_CACHE_SIZE_MB * 1024 * 1024
+        self.max_object_size = settings.MEMORY_CACHE_MAX_OBJECT_KB * 1024
+        self.ttl = settings.MEMORY_CACHE_TTL
+        self.size = 0
+        # (filename, variant) -> (CachedContent, expiration timestamp)
+        self._entries = collections.OrderedDict()
+        # filename -> variants cached for this file
+        self._variants = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def accepts(self, size):
+        return size <= self.max_object_size and size <= self.max_size
+
+    def get(self, filename, variant=""):
+        """
+        Returns the CachedContent of the file, or None if it is not cached
+        """
+        key = (filename, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached, expires = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return cached
+
+    def put(self, filename, content, variant="", etag=None, last_modified=None):
+        if not self.accepts(len(content)):
+            return
+        key = (filename, variant)
+        cached = CachedContent(content, etag, last_modified)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (cached, time.monotonic() + self.ttl)
+            self._variants[filename].add(variant)
+            self.size += len(content)
+
+            while self.size > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, filename):
+        """
+        Removes the file and all of its variants from the cache
+        """
+        with self._lock:
+            for variant in list(self._variants.get(filename, ())):
+                self._remove((filename, variant))
+
+    def _remove(self, key):
+        cached, _ = self._entries.pop(key)
+        self.size -= len(cached.content)
+
+        filename, variant = key
+        self._variants[filename].discard(variant)
+        if not self._variants[filename]:
+            del self._variants[filename]
+
+
+class ExistenceCache:
+    """
+    Remembers for `ttl` seconds whether a file exists on the storage provider.
+    Each worker has its own cache, so the TTL should stay short: a file uploaded or deleted
+    through another worker may be reported with its previous state until the entry expires.
+    """
+
+    MAX_ENTRIES = 100000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # filename -> (exists, expiration timestamp)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Returns True or False if the existence of the file is known, None otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            exists, expires = entry
+            if expires < time.monotonic():
+                del self._entries[filename]
+                return None
+            return exists
+
+    def set(self, filename, exists):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(filename, None)
+            self._entries[filename] = (exists, time.monotonic() + self.ttl)
+            if len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
@@ -0,0 +1,134 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+class DeduplicationIndex:
+    """
+    Maps the hash of the uploaded content to the name it is stored under, so that uploading
+    the same content again returns the existing name instead of storing a copy.
+
+    Each stored file has a reference count, incremented by every upload deduplicated onto it,
+    and decremented by every delete. The file is only removed from the storage once the count drops to zero.
+    The same content uploaded to different folders, or converted to different types, is stored separately.
+    Different contents can still end up under the same name, when they convert to the same image and names
+    are derived from the stored content: their hashes then share the reference count of that name.
+
+    The index is a SQLite database, which must be as durable as the files themselves,
+    and shared by all the imgpush instances using the same storage.
+    """
+
+    def __init__(self, path=None):
+        # The index lists every stored name, it is kept out of FILES_DIR so that it is never served
+        self.path = path or settings.DEDUPLICATION_INDEX_PATH or os.path.join(
+            os.path.dirname(settings.METRICS_FILE_PATH), "deduplication.sqlite3"
+        )
+        self._local = threading.local()
+
+    def acquire(self, digest, folder, extension):
+        """
+        Returns the name the content is already stored under, taking a new reference on it,
+        or None if the content was never uploaded
+        """
+        connection = self._connection()
+        with self._transaction(connection):
+            row = connection.execute(
+                "SELECT name FROM digests WHERE digest = ? AND folder = ? AND extension = ?",
+                (digest, folder, extension),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE files SET refcount = refcount + 1 WHERE name = ?", (row[0],)
+            )
+        return row[0]
+
+    def register(self, digest, folder, extension, name):
+        """
+        Records that the content is stored under `name`, and returns the name to hand out.
+        When a concurrent upload of the same content registered first, its name is returned instead,
+        and the caller is expected to remove the copy it stored under `name`.
+        When `name` is already registered for another content, the new hash takes a reference on it.
+        """
+        connection = self._connection()
+        with self._transaction(connection):
+            row = connection.execute(
+                "SELECT name FROM digests WHERE digest = ? AND folder = ? AND extension = ?",
+                (digest, folder, extension),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE files SET refcount = refcount + 1 WHERE name = ?", (row[0],)
+                )
+                return row[0]
+            connection.execute(
+                "INSERT INTO digests (digest, folder, extension, name) VALUES (?, ?, ?, ?)",
+                (digest, folder, extension, name),
+            )
+            connection.execute(
+                "INSERT INTO files (name, refcount) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET refcount = refcount + 1",
+                (name,),
+            )
+        return name
+
+    def release(self, name):
+        """
+        Drops a reference on `name`, and returns True if the file must be removed from the storage,
+        that is when this was the last reference, or when the file was not deduplicated
+        """
+        connection = self._connection()
+        with self._transaction(connection):
+            row = connection.execute(
+                "SELECT refcount FROM files WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                return True
+            if row[0] > 1:
+                connection.execute(
+                    "UPDATE files SET refcount = refcount - 1 WHERE name = ?", (name,)
+                )
+                return False
+            connection.execute("DELETE FROM files WHERE name = ?", (name,))
+            connection.execute("DELETE FROM digests WHERE name = ?", (name,))
+        return True
+
+    def _connection(self):
+        # SQLite connections can neither be shared between threads, nor survive a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._create_index(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextlib.contextmanager
+    def _transaction(self, connection):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _create_index(self, connection):
+        with self._transaction(connection):
+            # Several hashes can map to the same name, which holds the reference count of the stored file
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, refcount INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "digest TEXT NOT NULL, folder TEXT NOT NULL, extension TEXT NOT NULL, name TEXT NOT NULL, "
+                "PRIMARY KEY (digest, folder, extension))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS digests_name ON digests (name)")
@@ -13,10 +13,19 @@ fi
 
 echo "Configuration is valid."
 
-if [ "$REBUILD_METRICS" = "1" ]; then
+if [ "$REBUILD_METRICS" = "1" ] || [ "$REBUILD_METRICS" = "true" ]; then
     python3 rebuild_metrics.py
     exit 0
 fi
 
+# Each gunicorn worker writes its Prometheus samples to this directory, /metrics aggregates them
+export PROMETHEUS_MULTIPROC_DIR=/tmp/imgpush-prometheus
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# nginx resolves the S3 endpoint itself in the proxy serving mode
+nameserver=$(awk '/^nameserver/ { print $2; exit }' /etc/resolv.conf)
+echo "resolver ${nameserver:-127.0.0.11} valid=30s;" > /etc/nginx/conf.d/resolver.conf
+
 nginx
 gunicorn --bind unix:imgpush.sock wsgi:app --access-logfile -
@@ -4,6 +4,7 @@ import settings
 import storage
 import logging
 import mimetypes
+from wand.image import FILTER_TYPES
 
 logging.basicConfig(
     level=logging.INFO, format="[%(asctime)s] [Configuration] %(message)s"
@@ -63,8 +64,10 @@ def validate_general_settings():
         if mime_type not in known_mime_types:
             raise ValueError(f"{mime_type} is not a valid mime type")    
     
-    if settings.NAME_STRATEGY not in ["randomstr", "uuidv4"]:
-        raise ValueError("NAME_STRATEGY must be either 'randomstr' or 'uuidv4'")
+    if settings.NAME_STRATEGY not in ["randomstr", "uuidv4", "contenthash"]:
+        raise ValueError(
+            "NAME_STRATEGY must be either 'randomstr', 'uuidv4' or 'contenthash'"
+        )
 
     if settings.MAX_SIZE_MB < 1:
         raise ValueError("MAX_SIZE_MB must be greater than 0")
@@ -84,6 +87,194 @@ def validate_general_settings():
     if settings.MAX_UPLOADS_PER_DAY < 1:
         raise ValueError("MAX_UPLOADS_PER_DAY must be greater than 0")
 
+    _validate_uploads()
+    _validate_jobs()
+    _validate_s3_client()
+    _validate_eager_variants()
+    _validate_resize_profiles()
+    _validate_serving_modes()
+    _validate_caches()
+    _validate_background_tasks()
+
+
+def _validate_uploads():
+    if settings.RANDOM_NAME_LENGTH < 1:
+        raise ValueError("RANDOM_NAME_LENGTH must be greater than 0")
+
+    if (
+        settings.S3_ENDPOINT
+        and not settings.S3_CONDITIONAL_WRITES
+        and settings.NAME_STRATEGY == "randomstr"
+        and settings.RANDOM_NAME_LENGTH < 12
+    ):
+        # Without conditional writes two uploads can reserve the same name, long names make it unlikely
+        raise ValueError("RANDOM_NAME_LENGTH must be at least 12 when S3_CONDITIONAL_WRITES is disabled")
+
+    if (
+        settings.DEDUPLICATE_UPLOADS
+        and settings.S3_ENDPOINT
+        and not settings.DEDUPLICATION_INDEX_PATH
+    ):
+        raise ValueError(
+            "DEDUPLICATION_INDEX_PATH must be set to deduplicate the uploads stored on S3"
+        )
+
+    if settings.DIRECT_UPLOADS and not settings.S3_ENDPOINT:
+        raise ValueError("DIRECT_UPLOADS requires S3_ENDPOINT")
+
+    if settings.DIRECT_UPLOAD_EXPIRATION < 1:
+        raise ValueError("DIRECT_UPLOAD_EXPIRATION must be greater than 0")
+
+    if settings.MAX_SPOOL_SIZE_MB < 0:
+        raise ValueError("MAX_SPOOL_SIZE_MB must be positive")
+
+
+def _validate_jobs():
+    if settings.JOB_WORKERS < 1:
+        raise ValueError("JOB_WORKERS must be greater than 0")
+
+    if settings.JOB_QUEUE_SIZE < 0:
+        raise ValueError("JOB_QUEUE_SIZE must be positive")
+
+    if settings.JOB_TIMEOUT < 1:
+        raise ValueError("JOB_TIMEOUT must be greater than 0")
+
+    if settings.JOB_RETRY_AFTER < 1:
+        raise ValueError("JOB_RETRY_AFTER must be greater than 0")
+
+    if settings.IMAGEMAGICK_MEMORY_LIMIT_MB < 1:
+        raise ValueError("IMAGEMAGICK_MEMORY_LIMIT_MB must be greater than 0")
+
+    if settings.IMAGEMAGICK_AREA_LIMIT_MP < 1:
+        raise ValueError("IMAGEMAGICK_AREA_LIMIT_MP must be greater than 0")
+
+    if settings.IMAGEMAGICK_DISK_LIMIT_MB < 1:
+        raise ValueError("IMAGEMAGICK_DISK_LIMIT_MB must be greater than 0")
+
+
+def _validate_s3_client():
+    if settings.S3_MAX_POOL_CONNECTIONS < 1:
+        raise ValueError("S3_MAX_POOL_CONNECTIONS must be greater than 0")
+
+    if settings.S3_CONNECT_TIMEOUT < 1:
+        raise ValueError("S3_CONNECT_TIMEOUT must be greater than 0")
+
+    if settings.S3_READ_TIMEOUT < 1:
+        raise ValueError("S3_READ_TIMEOUT must be greater than 0")
+
+    if settings.S3_MAX_ATTEMPTS < 1:
+        raise ValueError("S3_MAX_ATTEMPTS must be greater than 0")
+
+    if settings.S3_MULTIPART_THRESHOLD_MB < 1:
+        raise ValueError("S3_MULTIPART_THRESHOLD_MB must be greater than 0")
+
+    if settings.S3_MULTIPART_CHUNK_SIZE_MB < 5:
+        # S3 rejects the parts smaller than 5 MB, except the last one
+        raise ValueError("S3_MULTIPART_CHUNK_SIZE_MB must be at least 5")
+
+    if settings.S3_MAX_CONCURRENCY < 1:
+        raise ValueError("S3_MAX_CONCURRENCY must be greater than 0")
+
+    if settings.S3_RETRY_MODE not in ["legacy", "standard", "adaptive"]:
+        raise ValueError("S3_RETRY_MODE must be either 'legacy', 'standard' or 'adaptive'")
+
+
+def _validate_eager_variants():
+    for size in settings.EAGER_RESIZE_SIZES:
+        if not re.match(r"^\d*x\d*$", size) or size == "x":
+            raise ValueError(
+                "EAGER_RESIZE_SIZES must be a list of sizes such as '320x240', '320x' or 'x240'"
+            )
+        for value in size.split("x"):
+            if value and settings.VALID_SIZES and int(value) not in settings.VALID_SIZES:
+                raise ValueError(f"EAGER_RESIZE_SIZES must only use VALID_SIZES, got {size}")
+
+    for output_type in settings.NEGOTIATED_OUTPUT_TYPES:
+        if output_type not in ["webp", "avif"]:
+            raise ValueError(
+                f"NEGOTIATED_OUTPUT_TYPES must only contain 'webp' and 'avif', got {output_type}"
+            )
+
+
+def _validate_resize_profiles():
+    if settings.DEFAULT_RESIZE_PROFILE not in settings.RESIZE_PROFILES:
+        raise ValueError("DEFAULT_RESIZE_PROFILE must be one of RESIZE_PROFILES")
+
+    for name, profile in settings.RESIZE_PROFILES.items():
+        if not re.match(r"^[\w\-]+$", name):
+            raise ValueError(f"RESIZE_PROFILES names must only contain letters, digits, - and _, got {name}")
+        if profile.get("method", "sample") not in ["sample", "resize", "two-stage"]:
+            raise ValueError(
+                f"RESIZE_PROFILES method must be either 'sample', 'resize' or 'two-stage' in profile {name}"
+            )
+        if profile.get("filter", "lanczos") not in FILTER_TYPES:
+            raise ValueError(f"RESIZE_PROFILES filter must be one of {FILTER_TYPES} in profile {name}")
+        if not 1 <= profile.get("quality", 1) <= 100:
+            raise ValueError(f"RESIZE_PROFILES quality must be between 1 and 100 in profile {name}")
+        if not 0 <= profile.get("webp_method", 0) <= 6:
+            raise ValueError(f"RESIZE_PROFILES webp_method must be between 0 and 6 in profile {name}")
+        if not 0 <= profile.get("png_compression_level", 0) <= 9:
+            raise ValueError(
+                f"RESIZE_PROFILES png_compression_level must be between 0 and 9 in profile {name}"
+            )
+
+
+def _validate_serving_modes():
+    if settings.S3_SERVING_MODE not in ["stream", "proxy", "redirect"]:
+        raise ValueError("S3_SERVING_MODE must be either 'stream', 'proxy' or 'redirect'")
+
+    if settings.S3_PRESIGNED_URL_EXPIRATION < 1:
+        raise ValueError("S3_PRESIGNED_URL_EXPIRATION must be greater than 0")
+
+    if (
+        settings.S3_SERVING_MODE == "redirect"
+        and settings.S3_PRESIGNED_URL_EXPIRATION <= settings.CACHE_CONTROL_MAX_AGE
+    ):
+        # Clients keep the redirection as long as the files, it must not point to an expired URL
+        raise ValueError(
+            "S3_PRESIGNED_URL_EXPIRATION must be greater than CACHE_CONTROL_MAX_AGE in redirect mode"
+        )
+
+    if settings.STREAM_CHUNK_SIZE_KB < 1:
+        raise ValueError("STREAM_CHUNK_SIZE_KB must be greater than 0")
+
+
+def _validate_caches():
+    if settings.CACHE_MAX_SIZE_MB < 0:
+        raise ValueError("CACHE_MAX_SIZE_MB must be positive")
+
+    if settings.CACHE_MAX_ENTRIES < 0:
+        raise ValueError("CACHE_MAX_ENTRIES must be positive")
+
+    if settings.RESIZE_FROM_VARIANT_MIN_SCALE and settings.RESIZE_FROM_VARIANT_MIN_SCALE < 1:
+        raise ValueError("RESIZE_FROM_VARIANT_MIN_SCALE must be 0 or at least 1")
+
+    if settings.MEMORY_CACHE_SIZE_MB < 0:
+        raise ValueError("MEMORY_CACHE_SIZE_MB must be positive")
+
+    if settings.MEMORY_CACHE_MAX_OBJECT_KB < 1:
+        raise ValueError("MEMORY_CACHE_MAX_OBJECT_KB must be greater than 0")
+
+    if settings.MEMORY_CACHE_TTL < 1:
+        raise ValueError("MEMORY_CACHE_TTL must be greater than 0")
+
+    if settings.EXISTENCE_CACHE_TTL < 0:
+        raise ValueError("EXISTENCE_CACHE_TTL must be positive")
+
+    if settings.CACHE_CONTROL_MAX_AGE < 0:
+        raise ValueError("CACHE_CONTROL_MAX_AGE must be positive")
+
+
+def _validate_background_tasks():
+    if settings.METRICS_FLUSH_INTERVAL < 1:
+        raise ValueError("METRICS_FLUSH_INTERVAL must be greater than 0")
+
+    if settings.REBUILD_METRICS_WORKERS < 1:
+        raise ValueError("REBUILD_METRICS_WORKERS must be greater than 0")
+
+    if settings.JANITOR_INTERVAL < 1:
+        raise ValueError("JANITOR_INTERVAL must be greater than 0")
+
 
 if __name__ == "__main__":
     # Check that general settings are valid
@@ -0,0 +1,10 @@
+# gunicorn loads this file from the working directory (/app) on startup
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # The samples of live gauges of a dead worker must not be aggregated anymore
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
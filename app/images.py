@@ -0,0 +1,246 @@
+"""
+Image processing functions.
+They run in the worker processes of the job pool, so they only take and return plain data
+(bytes, paths and sizes), and never depend on the Flask application.
+"""
+import logging
+import os
+
+from wand.exceptions import WandException
+from wand.image import Image
+from wand.resource import limits
+
+import settings
+import worker
+from cache import ResizedImageCache
+
+logger = logging.getLogger(__name__)
+
+resized_image_cache = ResizedImageCache()
+
+
+def apply_resource_limits():
+    """
+    Caps the resources ImageMagick may use in the current process, so that a single
+    pathological image fails its job instead of exhausting the host.
+    These limits can only lower the ones of ImageMagick's policy.xml.
+    """
+    limits["memory"] = settings.IMAGEMAGICK_MEMORY_LIMIT_MB * 1024 * 1024
+    limits["map"] = settings.IMAGEMAGICK_MEMORY_LIMIT_MB * 1024 * 1024
+    limits["area"] = settings.IMAGEMAGICK_AREA_LIMIT_MP * 1000 * 1000
+    limits["disk"] = settings.IMAGEMAGICK_DISK_LIMIT_MB * 1024 * 1024
+    limits["time"] = settings.JOB_TIMEOUT
+
+
+def convert_image(blob, output_type):
+    """
+    Converts the image `blob` to `output_type`, and returns the converted image as bytes.
+    The image is decoded once and converted in place, without any copy of its pixels.
+    """
+    with worker.stage("decode"):
+        img = Image(blob=blob)
+
+    with img:
+        with worker.stage("convert"):
+            img.strip()
+            if output_type not in ["gif"]:
+                # Only the first frame is kept
+                while len(img.sequence) > 1:
+                    del img.sequence[len(img.sequence) - 1]
+            img.format = output_type
+
+        with worker.stage("encode"):
+            return img.make_blob()
+
+
+def can_encode(output_type):
+    """
+    Tells whether the local ImageMagick build can write images of `output_type`, by encoding a single pixel.
+    Builds may list a format they can only read, e.g. AVIF without an encoder in libheif.
+    """
+    try:
+        with Image(width=1, height=1, pseudo="xc:white") as img:
+            img.format = output_type
+            img.make_blob()
+    except (ValueError, WandException):
+        return False
+    return True
+
+
+def read_image(source, size_hint=None):
+    """
+    Decodes `source`, either the content of an image or the path to a local file holding it.
+    `size_hint` is the (width, height) the image will be reduced to, missing dimensions being 0.
+    JPEG images are then decoded at the smallest scale (1/2, 1/4 or 1/8) that is still larger
+    than the hint on both sides, which is much faster for thumbnails of large photos.
+    """
+    img = Image()
+    try:
+        if size_hint and settings.SHRINK_ON_LOAD:
+            # Both sides are kept larger than the largest requested dimension,
+            # so that the image is still larger than the requested size once cropped
+            side = max(size_hint)
+            img.options["jpeg:size"] = f"{side}x{side}"
+        if isinstance(source, bytes):
+            img.read(blob=source)
+        else:
+            img.read(filename=source)
+    except Exception:
+        img.close()
+        raise
+    return img
+
+
+def crop_image(img, width, height):
+    """
+    Crops the image in place to the aspect ratio of the requested size.
+    Returns the requested size, with the missing dimension deduced from the aspect ratio.
+    """
+    current_aspect_ratio = img.width / img.height
+
+    if not width:
+        width = int(current_aspect_ratio * height)
+
+    if not height:
+        height = int(width / current_aspect_ratio)
+
+    desired_aspect_ratio = width / height
+
+    # Crop the image to fit the desired AR
+    if desired_aspect_ratio > current_aspect_ratio:
+        newheight = int(img.width / desired_aspect_ratio)
+        img.crop(
+            0,
+            int((img.height / 2) - (newheight / 2)),
+            width=img.width,
+            height=newheight,
+        )
+    else:
+        newwidth = int(img.height * desired_aspect_ratio)
+        img.crop(
+            int((img.width / 2) - (newwidth / 2)),
+            0,
+            width=newwidth,
+            height=img.height,
+        )
+
+    return width, height
+
+
+def scale_image(img, width, height, profile):
+    """
+    Scales the image in place to `width`x`height`, with the method of the resize `profile`:
+    - "sample" picks the nearest pixels, which is the fastest but aliases
+    - "resize" filters the whole image with the profile's filter, which is the slowest
+    - "two-stage" samples the image down to twice the requested size, then filters it
+    """
+    method = profile.get("method", "sample")
+    resize_filter = profile.get("filter", "lanczos")
+
+    if method == "two-stage" and img.width > 2 * width and img.height > 2 * height:
+        img.sample(2 * width, 2 * height)
+    if method == "sample":
+        img.sample(width, height)
+    else:
+        img.resize(width, height, filter=resize_filter)
+
+
+def set_encoder_options(img, profile, path):
+    """
+    Applies the output quality and the encoder effort of the resize `profile`
+    to the image, which is about to be written to `path`
+    """
+    _, extension = os.path.splitext(path)
+    extension = extension.lower()
+
+    # For PNG, ImageMagick reads the quality as the compression level and filter instead
+    if "quality" in profile and extension in [".jpg", ".jpeg", ".webp"]:
+        img.compression_quality = profile["quality"]
+    if "webp_method" in profile and extension == ".webp":
+        img.options["webp:method"] = str(profile["webp_method"])
+    if "png_compression_level" in profile and extension == ".png":
+        img.options["png:compression-level"] = str(profile["png_compression_level"])
+
+
+def resize_image(source, destination_path, width, height, profile_name):
+    """
+    Resizes the image `source` with the resize profile `profile_name`,
+    and writes the result to `destination_path`.
+    `source` is either the content of the image, or the path to a local file holding it.
+    The image is decoded once and resized in place. Returns the (width, height) of the result.
+    """
+    profile = settings.RESIZE_PROFILES[profile_name]
+
+    with worker.stage("decode"):
+        img = read_image(source, (width or 0, height or 0))
+
+    with img:
+        with worker.stage("resize"):
+            width, height = crop_image(img, width, height)
+            scale_image(img, width, height, profile)
+            img.strip()
+        with worker.stage("encode"):
+            set_encoder_options(img, profile, destination_path)
+            img.save(filename=destination_path)
+    return width, height
+
+
+def get_resized_filename(filename, width, height, profile_name, output_type=None):
+    filename_without_extension, extension_with_dot = os.path.splitext(filename)
+    # ImageMagick picks the output format from the extension
+    extension = output_type or extension_with_dot[1:]  # remove the dot from the extension
+    dimensions = f"{width}x{height}"
+    return f"{filename_without_extension}_{dimensions}_{profile_name}.{extension}"
+
+
+def render_variants(blob, filename, sizes, profile_name, output_types=()):
+    """
+    Renders each (width, height) of `sizes` with the resize profile `profile_name`
+    into the resized images cache, in the format of `filename` and in each of `output_types`.
+    The image `blob` is decoded only once for all of them, and resized once per size.
+
+    The variants already cached are skipped, as well as those a request is rendering: the request holds
+    their lock while it waits for a worker, so waiting for the lock from a worker could exhaust them.
+    """
+    profile = settings.RESIZE_PROFILES[profile_name]
+
+    # The image is decoded for the largest of the sizes
+    size_hint = (
+        max(width or 0 for width, _ in sizes),
+        max(height or 0 for _, height in sizes),
+    )
+    with worker.stage("decode"):
+        image = read_image(blob, size_hint)
+
+    with image:
+        for width, height in sizes:
+            resized_filenames = [
+                get_resized_filename(filename, width, height, profile_name, output_type)
+                for output_type in [None, *output_types]
+            ]
+            if all(
+                os.path.isfile(os.path.join(resized_image_cache.directory, resized_filename))
+                for resized_filename in resized_filenames
+            ):
+                continue
+
+            with image.clone() as resized_image:
+                with worker.stage("resize"):
+                    resized_width, resized_height = crop_image(
+                        resized_image, width, height
+                    )
+                    scale_image(resized_image, resized_width, resized_height, profile)
+
+                for resized_filename in resized_filenames:
+
+                    def render(path):
+                        # Each format is encoded from its own copy, so that encoder options do not leak
+                        with worker.stage("encode"), resized_image.clone() as encoded_image:
+                            set_encoder_options(encoded_image, profile, path)
+                            encoded_image.save(filename=path)
+                        return resized_width, resized_height, bool(width and height)
+
+                    resized_image_cache.render(
+                        resized_filename, render, filename, profile_name, blocking=False
+                    )
+    logger.info("Eager variants rendered for %s", filename)
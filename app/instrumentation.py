@@ -0,0 +1,110 @@
+"""
+Prometheus metrics describing the activity of imgpush itself.
+
+When PROMETHEUS_MULTIPROC_DIR is set (see entrypoint.sh), each gunicorn worker writes its samples
+to that directory, and the /metrics endpoint aggregates the samples of all the workers.
+"""
+import os
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+REQUESTS = Counter(
+    "imgpush_requests",
+    "HTTP requests, by endpoint, method and status code",
+    ["endpoint", "method", "status"],
+)
+REQUEST_DURATION_SECONDS = Histogram(
+    "imgpush_request_duration_seconds",
+    "Time spent handling HTTP requests, until the response starts being sent",
+    ["endpoint", "method"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "imgpush_requests_in_flight",
+    "HTTP requests being handled",
+    multiprocess_mode="livesum",
+)
+REQUEST_BYTES = Counter(
+    "imgpush_request_bytes",
+    "Bytes received in HTTP request bodies, by endpoint",
+    ["endpoint"],
+)
+RESPONSE_BYTES = Counter(
+    "imgpush_response_bytes",
+    "Bytes sent in HTTP response bodies, by endpoint. Files handed over to nginx are counted as well",
+    ["endpoint"],
+)
+STAGE_DURATION_SECONDS = Histogram(
+    "imgpush_stage_duration_seconds",
+    "Time spent in each stage of the uploads and downloads (sniff, hash, storage_save, storage_open, "
+    "storage_get, decode, convert, resize, encode)",
+    ["stage"],
+)
+CACHE_LOOKUPS = Counter(
+    "imgpush_cache_lookups",
+    "Lookups in the memory cache and in the resized images cache, by result (hit, miss)",
+    ["cache", "result"],
+)
+JOBS = Counter(
+    "imgpush_jobs",
+    "Image processing jobs, by outcome (completed, failed, timeout, rejected)",
+    ["job", "outcome"],
+)
+JOBS_PENDING = Gauge(
+    "imgpush_jobs_pending",
+    "Image processing jobs waiting for a worker process or running",
+    multiprocess_mode="livesum",
+)
+JOB_WAIT_SECONDS = Histogram(
+    "imgpush_job_wait_seconds",
+    "Time spent by image processing jobs waiting for a worker process",
+    ["job"],
+)
+JOB_DURATION_SECONDS = Histogram(
+    "imgpush_job_duration_seconds",
+    "Time spent by image processing jobs running in a worker process",
+    ["job"],
+)
+DEDUPLICATED_UPLOADS = Counter(
+    "imgpush_deduplicated_uploads",
+    "Uploads whose content was already stored, and which were given the existing name",
+)
+JANITOR_FILES_SCANNED = Counter(
+    "imgpush_janitor_files_scanned",
+    "Temporary files looked at by the janitor, by location",
+    ["location"],
+)
+JANITOR_FILES_REMOVED = Counter(
+    "imgpush_janitor_files_removed",
+    "Stale temporary files removed by the janitor, by location",
+    ["location"],
+)
+JANITOR_BYTES_REMOVED = Counter(
+    "imgpush_janitor_bytes_removed",
+    "Bytes reclaimed by the janitor, by location",
+    ["location"],
+)
+JANITOR_SCAN_SECONDS = Histogram(
+    "imgpush_janitor_scan_seconds",
+    "Time spent by the janitor sweeping a location",
+    ["location"],
+)
+
+
+def generate_metrics():
+    """
+    Returns the metrics of all the workers, in the Prometheus text format
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry).decode("utf-8")
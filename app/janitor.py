@@ -0,0 +1,113 @@
+"""
+Background removal of the temporary files left behind by crashed or killed jobs and requests.
+"""
+import fcntl
+import fnmatch
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import instrumentation
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_temporary_locations():
+    """
+    Returns the (name, directory, pattern) of every location where imgpush leaves temporary files
+    """
+    locations = [
+        # ImageMagick pixel caches of images too large to be kept in memory
+        ("imagemagick", tempfile.gettempdir(), "magick-*"),
+        # Resized variants being written to the cache
+        ("cache", os.path.join(settings.CACHE_DIR, ".tmp"), "*"),
+    ]
+    if settings.FILES_DIR:
+        # Uploads being written to the storage
+        locations.append(("uploads", os.path.join(settings.FILES_DIR, ".tmp"), "*"))
+    return locations
+
+
+def sweep(max_age):
+    """
+    Removes the temporary files older than `max_age` seconds.
+    Returns the number of files removed.
+    """
+    removed = 0
+    now = time.time()
+    for location, directory, pattern in get_temporary_locations():
+        started_at = time.time()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+
+        for entry in entries:
+            if not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if now - stat.st_mtime <= max_age:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by its owner in the meantime
+                continue
+            except OSError as e:
+                logger.error(f"Could not remove temporary file {entry.path}: {e}")
+                continue
+            removed += 1
+            instrumentation.JANITOR_FILES_REMOVED.labels(location).inc()
+            instrumentation.JANITOR_BYTES_REMOVED.labels(location).inc(stat.st_size)
+
+        instrumentation.JANITOR_FILES_SCANNED.labels(location).inc(len(entries))
+        instrumentation.JANITOR_SCAN_SECONDS.labels(location).observe(
+            time.time() - started_at
+        )
+    return removed
+
+
+class Janitor:
+    """
+    Sweeps the temporary files every `interval` seconds, in a daemon thread.
+    Every gunicorn worker runs a janitor, but a lock under CACHE_DIR makes sure
+    only one of them sweeps at a time.
+    """
+
+    def __init__(self, interval, max_age):
+        self.interval = interval
+        self.max_age = max_age
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep_once()
+            except Exception as e:
+                logger.error(f"Error while sweeping the temporary files: {e}")
+
+    def sweep_once(self):
+        """
+        Sweeps the temporary files, unless another worker is already doing it
+        """
+        lock_dir = os.path.join(settings.CACHE_DIR, ".locks")
+        os.makedirs(lock_dir, exist_ok=True)
+
+        with open(os.path.join(lock_dir, "janitor.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            removed = sweep(self.max_age)
+        if removed:
+            logger.info("Janitor removed %s temporary files", removed)
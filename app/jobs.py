@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+
+import instrumentation
+import worker
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class JobFailedError(Exception):
+    pass
+
+
+class JobPool:
+    """
+    Runs the image processing jobs in separate processes, so that ImageMagick never runs
+    on the request threads, and so that a job can be killed once it exceeds its deadline.
+
+    At most `workers` jobs run at once, and at most `queue_size` more wait for their turn,
+    for up to `queue_timeout` seconds. Jobs submitted beyond that are rejected with a QueueFullError.
+
+    Each job runs in its own process, forked from a fork server that preloads the modules
+    listed in `preload`, so starting a job is cheap and its memory is released as soon as it ends.
+    `initializer` is called in the job process before the job itself, e.g. to set resource limits.
+    """
+
+    def __init__(self, workers, queue_size, queue_timeout, preload=(), initializer=None):
+        self.queue_timeout = queue_timeout
+        self.initializer = initializer
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._workers = threading.BoundedSemaphore(workers)
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(list(preload))
+
+    def submit(self, function, *args, timeout):
+        """
+        Submits the job without waiting for it, and returns a Future.
+        Raises QueueFullError when the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            instrumentation.JOBS.labels(function.__name__, "rejected").inc()
+            raise QueueFullError
+
+        future = Future()
+        thread = threading.Thread(
+            target=self._execute,
+            args=(future, function, args, timeout),
+            name=f"job-{function.__name__}",
+            daemon=True,
+        )
+        instrumentation.JOBS_PENDING.inc()
+        try:
+            thread.start()
+        except Exception:
+            instrumentation.JOBS_PENDING.dec()
+            self._slots.release()
+            raise
+        return future
+
+    def run(self, function, *args, timeout):
+        """
+        Runs the job and returns its result. The job process is killed after `timeout` seconds.
+        Raises QueueFullError when the queue is full, JobTimeoutError when the job
+        waited or ran for too long, and re-raises the exception raised by the job otherwise.
+        """
+        return self.submit(function, *args, timeout=timeout).result()
+
+    def _execute(self, future, function, args, timeout):
+        job = function.__name__
+        outcome = "failed"
+        try:
+            submitted_at = time.time()
+            if not self._workers.acquire(timeout=self.queue_timeout):
+                outcome = "timeout"
+                raise JobTimeoutError
+            try:
+                instrumentation.JOB_WAIT_SECONDS.labels(job).observe(
+                    time.time() - submitted_at
+                )
+                result, started_at, finished_at = self._run_process(
+                    function, args, timeout
+                )
+            finally:
+                self._workers.release()
+
+            outcome = "completed"
+            instrumentation.JOB_DURATION_SECONDS.labels(job).observe(
+                finished_at - started_at
+            )
+            future.set_result(result)
+        except JobTimeoutError as e:
+            outcome = "timeout"
+            future.set_exception(e)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            instrumentation.JOBS.labels(job, outcome).inc()
+            instrumentation.JOBS_PENDING.dec()
+            self._slots.release()
+
+    def _run_process(self, function, args, timeout):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=worker.run_job,
+            args=(sender, self.initializer, function, args),
+            daemon=True,
+        )
+        process.start()
+        # Only the job process writes to the pipe, so that a crash is seen as the end of the pipe
+        sender.close()
+
+        try:
+            if not receiver.poll(timeout):
+                logger.warning(
+                    "Job %s exceeded its %ss deadline, killing it", function.__name__, timeout
+                )
+                process.kill()
+                raise JobTimeoutError
+            try:
+                status, payload, started_at, finished_at, stages = receiver.recv()
+            except EOFError:
+                process.join()
+                raise JobFailedError(
+                    f"Job process exited with code {process.exitcode} without a result"
+                )
+        finally:
+            receiver.close()
+            process.join()
+
+        for stage, seconds in stages:
+            instrumentation.STAGE_DURATION_SECONDS.labels(stage).observe(seconds)
+
+        if status == "error":
+            raise payload
+        if status == "failed":
+            raise JobFailedError(payload)
+        return payload, started_at, finished_at
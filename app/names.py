@@ -0,0 +1,49 @@
+"""
+Allocation of the names of the uploaded files.
+The names are only generated here, they are reserved by the storage provider when the file is saved.
+"""
+import hashlib
+import secrets
+import string
+import uuid
+
+import settings
+
+RANDOM_NAME_ALPHABET = string.ascii_lowercase + string.digits + string.ascii_uppercase
+# Names of the contenthash strategy are the first 128 bits of the SHA-256 of the content
+CONTENT_HASH_LENGTH = 32
+# Number of names tried before an upload is given up, collisions are unlikely with random names
+MAX_ATTEMPTS = 5
+
+
+def generate_name(file):
+    """
+    Returns a name, without extension, for the content of the seekable file-like object `file`.
+    The file is read back to its start when the name depends on its content.
+    """
+    if settings.NAME_STRATEGY == "uuidv4":
+        return str(uuid.uuid4())
+    if settings.NAME_STRATEGY == "contenthash":
+        return hash_content(file)[:CONTENT_HASH_LENGTH]
+    return "".join(
+        secrets.choice(RANDOM_NAME_ALPHABET) for _ in range(settings.RANDOM_NAME_LENGTH)
+    )
+
+
+def hash_content(file):
+    """
+    Returns the SHA-256 hex digest of the content of `file`, reading it in chunks
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    while chunk := file.read(settings.STREAM_CHUNK_SIZE_KB * 1024):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def is_deterministic():
+    """
+    Returns True when the same content is always given the same name
+    """
+    return settings.NAME_STRATEGY == "contenthash"
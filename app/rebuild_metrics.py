@@ -1,11 +1,20 @@
-import mimetypes
 import os
 import datetime
 import logging
+import string
+import threading
 import time
-from storage import S3Storage, get_storage
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from storage import (
+    UPLOADS_PREFIX,
+    FileSystemStorage,
+    add_to_metrics,
+    build_path,
+    get_storage,
+    merge_metrics,
+    rewrite_metrics_file,
+)
 import settings
-from collections import defaultdict
 import json
 
 # Set up logging
@@ -18,13 +27,8 @@ logger.addHandler(handler)
 
 # Fetching storage provider
 storage = get_storage()
-if storage.__class__.__name__ == "FileSystemStorage":
-    logger.error("Cannot rebuild metrics with FileSystemStorage")
-    exit(1)
-
-storage: S3Storage = storage
 
-logger.info("Rebuilding from S3 bucket")
+logger.info(f"Rebuilding from {storage.__class__.__name__}")
 for line in storage.__str__().split("\n"):
     logger.info(line)
 
@@ -39,56 +43,287 @@ def process_object(object, metrics):
         if filename.endswith("/"):
             return
 
-        file_extension = filename.split(".")[-1]
-        mime_type = mimetypes.types_map.get(f".{file_extension}", "others")
+        # The folders are relative to the root of the storage, as in the uploaded filenames
+        filename = os.path.relpath(filename, settings.S3_FOLDER_NAME or ".")
+
+        # Skip the direct uploads that were not finalized yet
+        if filename.startswith(UPLOADS_PREFIX):
+            return
 
         # Update the metrics
-        metrics[mime_type]["count"] += 1
-        metrics[mime_type]["total_size"] += size
+        add_to_metrics(metrics, filename, size)
     except Exception as e:
         logger.error(f"Error processing object {object['Key']}: {str(e)}")
 
 
-metrics = defaultdict(lambda: {"count": 0, "total_size": 0})
+def scan_directory(directory, metrics):
+    """
+    Adds the files under `directory` to the metrics, walking it with os.scandir.
+    Returns the number of files found.
+    """
+    count = 0
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = os.scandir(current)
+        except OSError as e:
+            logger.error(f"Error listing directory {current}: {str(e)}")
+            continue
+
+        with entries:
+            for entry in entries:
+                # Skip the temporary files and the indexes
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        filename = os.path.relpath(entry.path, directory)
+                        add_to_metrics(metrics, filename, entry.stat().st_size)
+                        count += 1
+                except OSError as e:
+                    # The file may have been deleted in the meantime
+                    logger.error(f"Error processing file {entry.path}: {str(e)}")
+    return count
 
-# Fetch all objects from the S3 bucket
-all_objects = []
-paginator = storage.s3.get_paginator("list_objects_v2")
-start_time = time.time()
 
-logger.info("Fetching all objects from S3 bucket...")
+# The listing of a folder larger than a page is split at these first characters, so that the parts are listed
+# in parallel. They cover the names generated by imgpush, other keys are still listed, in the neighbouring part.
+PARTITION_CHARACTERS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+# Number of seconds between two saves of the progress of the listing
+CHECKPOINT_INTERVAL = 10
 
-try:
-    for index, page in enumerate(
-        paginator.paginate(
-            Bucket=settings.S3_BUCKET_NAME, Prefix=settings.S3_FOLDER_NAME
-        )
-    ):
+
+def get_partitions(prefix):
+    """
+    Splits the keys directly under `prefix` into disjoint ranges, each given as
+    (start_after, end): the part holds the keys greater than `start_after` (if any),
+    and lower than or equal to `end` (if any). Together, the parts cover every key.
+    """
+    boundaries = [prefix + character for character in sorted(PARTITION_CHARACTERS)]
+    return list(zip([None] + boundaries, boundaries + [None]))
+
+
+class Checkpoint:
+    """
+    Progress of the listing of each part, saved next to the metrics file so that
+    an interrupted rebuild resumes where it stopped instead of listing the whole bucket again.
+    A folder is added as a single part as soon as it is found, by the part listing its parent.
+    Only when its first page is full is the rest of the folder split into parts listed in parallel,
+    so that small folders cost a single request.
+    """
+
+    def __init__(self):
+        self.path = f"{settings.METRICS_FILE_PATH}.checkpoint"
+        self._lock = threading.Lock()
+        self._saved_at = time.time()
+        self.parts = []
+        self.folders = []
+        self.add_folder(build_path(""))
+
+    def load(self):
         try:
-            page_content = page["Contents"]
-            object_count = len(page_content)
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        # A checkpoint of another bucket, or of a different split, cannot be resumed
+        if checkpoint.get("source") != self._source():
+            logger.info("Ignoring the checkpoint of a different rebuild")
+            return
+        self.parts = checkpoint["parts"]
+        self.folders = checkpoint["folders"]
+        done = sum(part["done"] for part in self.parts)
+        logger.info(f"Resuming from checkpoint, {done}/{len(self.parts)} parts already listed")
+
+    def add_folder(self, prefix):
+        """
+        Adds the part listing the first page of the folder `prefix`, unless it was already added.
+        Returns the indexes of the new parts.
+        """
+        if prefix in self.folders:
+            return []
+        self.folders.append(prefix)
+        return self._add_parts(prefix, [(None, None)], split=False)
+
+    def advance(self, index, last_key, count, metrics, folders=(), done=False, truncated=False):
+        """
+        Records that the part `index` was listed up to `last_key`, adding the counts and the folders of that page.
+        When the first page of a folder is `truncated`, the rest of the folder is split into parts.
+        Returns the indexes of the parts of the new folders, and of the rest of the folder.
+        """
+        with self._lock:
+            part = self.parts[index]
+            if last_key is not None:
+                part["start_after"] = last_key
+            part["count"] += count
+            part["done"] = done
+            merge_metrics(part["metrics"], metrics)
+            indexes = [new_index for folder in folders for new_index in self.add_folder(folder)]
+            if truncated:
+                indexes += self._add_parts(
+                    part["prefix"],
+                    [
+                        (start_after if start_after is not None and start_after > last_key else last_key, end)
+                        for start_after, end in get_partitions(part["prefix"])
+                        if end is None or end > last_key
+                    ],
+                    split=True,
+                )
+            if done or indexes or time.time() - self._saved_at > CHECKPOINT_INTERVAL:
+                self._save()
+            return indexes
+
+    def save(self):
+        with self._lock:
+            self._save()
 
-            logger.info(
-                f"Fetched {object_count} {'more ' if index > 0 else ''}objects... ({index + 1}/{'?' if object_count == 1000 else index + 1})"
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _add_parts(self, prefix, ranges, split):
+        indexes = range(len(self.parts), len(self.parts) + len(ranges))
+        self.parts.extend(
+            {
+                "prefix": prefix,
+                "start_after": start_after,
+                "end": end,
+                "split": split,
+                "done": False,
+                "count": 0,
+                "metrics": {},
+            }
+            for start_after, end in ranges
+        )
+        return list(indexes)
+
+    def _save(self):
+        checkpoint = {"source": self._source(), "parts": self.parts, "folders": self.folders}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.path)
+        self._saved_at = time.time()
+
+    def _source(self):
+        return {
+            "bucket": settings.S3_BUCKET_NAME,
+            "folder": settings.S3_FOLDER_NAME,
+            "characters": PARTITION_CHARACTERS,
+        }
+
+
+def list_page(page):
+    """
+    Returns the objects and the folders of a page of a listing, in the order of their keys
+    """
+    entries = [(object["Key"], object) for object in page.get("Contents", [])]
+    entries += [(folder["Prefix"], None) for folder in page.get("CommonPrefixes", [])]
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+def scan_partition(index, checkpoint):
+    """
+    Lists the part `index` of the bucket, aggregating the objects page by page.
+    Folders are not listed here but added as parts of their own, whose indexes are returned.
+    The first part of a folder only lists its first page, and returns the parts of the rest if there is one.
+    """
+    part = checkpoint.parts[index]
+    if part["done"]:
+        return []
+
+    parameters = {"Bucket": settings.S3_BUCKET_NAME, "Prefix": part["prefix"], "Delimiter": "/"}
+    if part["start_after"] is not None:
+        parameters["StartAfter"] = part["start_after"]
+
+    new_indexes = []
+    paginator = storage.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**parameters):
+        metrics = {}
+        count = 0
+        last_key = None
+        folders = []
+        for key, object in list_page(page):
+            if part["end"] is not None and key > part["end"]:
+                # The rest belongs to the next part
+                return new_indexes + checkpoint.advance(index, last_key, count, metrics, folders, done=True)
+            if object is None:
+                # The direct uploads that were not finalized yet are skipped
+                if key != build_path(UPLOADS_PREFIX):
+                    folders.append(key)
+            else:
+                process_object(object, metrics)
+                count += 1
+            last_key = key
+        if not part["split"]:
+            return new_indexes + checkpoint.advance(
+                index, last_key, count, metrics, folders, done=True, truncated=page.get("IsTruncated", False)
             )
-            all_objects.extend(page["Contents"])
-        except Exception as e:
-            logger.error(f"Error fetching objects: {str(e)}")
-except Exception as e:
-    logger.error(f"Error listing objects: {str(e)}")
-    exit(1)
+        new_indexes += checkpoint.advance(index, last_key, count, metrics, folders)
+    return new_indexes + checkpoint.advance(index, None, 0, {}, done=True)
+
+
+def scan_bucket(metrics):
+    """
+    Adds the objects of the bucket to the metrics, listing its parts in parallel.
+    Returns the number of objects found.
+    """
+    checkpoint = Checkpoint()
+    checkpoint.load()
+
+    logger.info(f"Listing the bucket by folder, {settings.REBUILD_METRICS_WORKERS} parts at a time...")
+
+    with ThreadPoolExecutor(max_workers=settings.REBUILD_METRICS_WORKERS) as executor:
+        pending = {
+            executor.submit(scan_partition, index, checkpoint)
+            for index in range(len(checkpoint.parts))
+        }
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    new_indexes = future.result()
+                except Exception as e:
+                    # The checkpoint is kept, the next run resumes the parts that failed
+                    logger.error(f"Error listing objects: {str(e)}")
+                    for other in pending:
+                        other.cancel()
+                    checkpoint.save()
+                    exit(1)
+                pending |= {executor.submit(scan_partition, index, checkpoint) for index in new_indexes}
+            listed = sum(part["done"] for part in checkpoint.parts)
+            logger.info(f"Listed {listed}/{len(checkpoint.parts)} parts")
 
-logger.info(f"Got {len(all_objects)} objects to process. Calculating metrics now")
+    count = 0
+    for part in checkpoint.parts:
+        merge_metrics(metrics, part["metrics"])
+        count += part["count"]
+    checkpoint.remove()
+    return count
 
-# Process the objects
-last_time = time.time()
-for object in all_objects:
-    process_object(object, metrics)
+
+metrics = {}
+start_time = time.time()
+
+if isinstance(storage, FileSystemStorage):
+    logger.info(f"Scanning {settings.FILES_DIR}...")
+    object_count = scan_directory(settings.FILES_DIR, metrics)
+else:
+    object_count = scan_bucket(metrics)
 end_time = time.time()
 
+for folder, folder_metrics in sorted(metrics.get("folders", {}).items()):
+    folder_count = sum(data["count"] for data in folder_metrics.values())
+    folder_size = sum(data["total_size"] for data in folder_metrics.values())
+    logger.info(f"Folder {folder or '/'}: {folder_count} files, {folder_size} bytes")
+
 # Calculate time metrics
 total_time = end_time - start_time
-average_time = total_time / len(all_objects) if len(all_objects) > 0 else 0
+average_time = total_time / object_count if object_count > 0 else 0
 
 # Storing the metrics
 metrics["last_execution_time_in_milliseconds"] = int(total_time * 1000)
@@ -99,12 +334,9 @@ logger.info(
 )
 logger.info(f"Saving file to {settings.METRICS_FILE_PATH}")
 
-# Saving the metrics to a file
-# if the file doesn't exist, create it
+# Saving the metrics to a file, under the lock the workers take to merge their own changes
 try:
-    os.makedirs(os.path.dirname(settings.METRICS_FILE_PATH), exist_ok=True)
-    with open(settings.METRICS_FILE_PATH, "w") as f:
-        json.dump(metrics, f)
+    rewrite_metrics_file(lambda previous_metrics: metrics)
     logger.info("Metrics saved!")
 except Exception as e:
     logger.error(f"Error saving metrics: {str(e)}")
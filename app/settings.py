@@ -7,19 +7,75 @@ import logging
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [Settings] %(message)s")
 logger = logging.getLogger(__name__)
 
-# If this option is set to None, FILES_DIR will be used. Otherwise, imgpush will try establish a connection to the S3 endpoint
+# If this option is set to None, FILES_DIR will be used.
+# Otherwise, imgpush will try establish a connection to the S3 endpoint
 S3_ENDPOINT = ""
 S3_ACCESS_KEY_ID = ""
 S3_SECRET_ACCESS_KEY = ""
 S3_BUCKET_NAME = ""
 S3_FOLDER_NAME = ""
+# How the files stored on S3 are served: "stream" through imgpush, "proxy" through nginx,
+# or "redirect" to a presigned URL
+S3_SERVING_MODE = "stream"
+# Number of seconds the presigned URLs of the proxy and redirect modes are valid
+S3_PRESIGNED_URL_EXPIRATION = 2 * 60 * 60
+# Maximum number of connections to S3 kept open by each worker, shared by its threads and transfers
+S3_MAX_POOL_CONNECTIONS = 50
+# Number of seconds to wait for a connection to S3, and for a response
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 60
+# How the failed requests to S3 are retried: "legacy", "standard",
+# or "adaptive", which also slows down when S3 throttles
+S3_RETRY_MODE = "adaptive"
+# Maximum number of attempts of a request to S3, including the first one
+S3_MAX_ATTEMPTS = 5
+# Uploads larger than the threshold are sent in parts of S3_MULTIPART_CHUNK_SIZE_MB
+S3_MULTIPART_THRESHOLD_MB = 8
+S3_MULTIPART_CHUNK_SIZE_MB = 8
+# Maximum number of parts of an upload sent at the same time
+S3_MAX_CONCURRENCY = 10
+# Names are reserved by S3 itself with If-None-Match. Disable it for the providers that do not support it,
+# names are then checked with a HEAD before the PUT
+S3_CONDITIONAL_WRITES = True
+# Lets clients upload files straight to S3 with presigned posts, see POST /uploads
+DIRECT_UPLOADS = False
+# Number of seconds the presigned posts of direct uploads are valid
+DIRECT_UPLOAD_EXPIRATION = 15 * 60
 
 # The directory in which to store the files
 FILES_DIR = None
 # The directory in which to store "cached" resized imges
 CACHE_DIR = "/cache/"
-# This is the path to the metrics file, used by the metrics endpoint for the S3Storage class
+# Maximum size of CACHE_DIR, the least recently used resized images are evicted beyond (0 means unlimited)
+CACHE_MAX_SIZE_MB = 0
+# Maximum number of resized images kept in CACHE_DIR (0 means unlimited)
+CACHE_MAX_ENTRIES = 0
+# Resized images are derived from a cached variant at least this many times larger,
+# rather than from the original (0 disables it)
+RESIZE_FROM_VARIANT_MIN_SCALE = 1.5
+# Size of the in-memory cache of small files, kept by each worker (0 disables it)
+MEMORY_CACHE_SIZE_MB = 0
+# Files larger than this are never kept in the in-memory cache
+MEMORY_CACHE_MAX_OBJECT_KB = 512
+# Number of seconds a file stays in the in-memory cache. Each worker has its own cache, and only drops
+# the files deleted through itself: the other workers can serve a deleted file until it expires
+MEMORY_CACHE_TTL = 60
+# Number of seconds the existence of a file on S3 is remembered by each worker (0 disables it)
+EXISTENCE_CACHE_TTL = 0
+# Number of seconds clients and CDNs may keep the files before revalidating them
+CACHE_CONTROL_MAX_AGE = 60 * 60
+# Mark the files as immutable, so that clients never revalidate them before they expire.
+# Names never change once written
+CACHE_CONTROL_IMMUTABLE = False
+# Local files (originals in FILES_DIR and resized images) are sent by nginx.
+# Disable it when imgpush does not run behind the bundled nginx
+NGINX_ACCEL_REDIRECT = True
+# This is the path to the metrics file, used by the metrics endpoint
 METRICS_FILE_PATH = "/metrics/metrics.json"
+# Number of seconds between two merges of the metrics of a worker into METRICS_FILE_PATH
+METRICS_FLUSH_INTERVAL = 5
+# Number of parts of the bucket listed in parallel by the metrics-rebuilder
+REBUILD_METRICS_WORKERS = 8
 # Convert the files to this type when uploading
 # NOTE: This will only apply to file extensions from the RESIZABLE_MIME_FILE_TYPES setting
 OUTPUT_TYPE = None
@@ -31,18 +87,64 @@ OUTPUT_TYPE = None
 MAX_UPLOADS_PER_DAY = 1000
 MAX_UPLOADS_PER_HOUR = 100
 MAX_UPLOADS_PER_MINUTE = 20
+# Temporary files older than this many seconds are considered leftovers, and removed by the janitor
 MAX_TMP_FILE_AGE = 5 * 60
+# Number of seconds between two sweeps of the temporary files
+JANITOR_INTERVAL = 60
+# Maximum number of seconds a resize runs before its process is killed
 RESIZE_TIMEOUT = 5
+# Decode large JPEG images at a reduced scale when they are resized to a much smaller size
+SHRINK_ON_LOAD = True
 MAX_SIZE_MB = 16
+# Number of worker processes running the image conversions and resizes, in each gunicorn worker
+JOB_WORKERS = 2
+# Number of jobs waiting for a worker process, beyond which requests are rejected with a 503
+JOB_QUEUE_SIZE = 8
+# Maximum number of seconds a job waits for a worker process, and a conversion runs before its process is killed
+JOB_TIMEOUT = 30
+# Value of the Retry-After header sent when the job queue is full
+JOB_RETRY_AFTER = 5
+# Memory ImageMagick may use for a single job, it fails the job beyond
+IMAGEMAGICK_MEMORY_LIMIT_MB = 256
+# Largest image, in megapixels, ImageMagick keeps in memory for a single job, it is cached on disk beyond
+IMAGEMAGICK_AREA_LIMIT_MP = 128
+# Disk space ImageMagick may use for a single job, it fails the job beyond
+IMAGEMAGICK_DISK_LIMIT_MB = 1024
+# Size of the chunks used when streaming files to and from the storage provider
+STREAM_CHUNK_SIZE_KB = 256
+# Uploaded files, and direct uploads fetched from S3, are kept in memory up to this size,
+# and spilled to a temporary file beyond. Converted images are always kept in memory
+MAX_SPOOL_SIZE_MB = 4
 
 #########################################
 ######          OTHERS              #####
 #########################################
 
 ALLOWED_ORIGINS = ["*"]
-# Possible values: randomstr, uuidv4
+# Possible values: randomstr, uuidv4, contenthash
 NAME_STRATEGY = "randomstr"
+# Number of characters of the names generated by the randomstr strategy
+RANDOM_NAME_LENGTH = 12
+# Uploading a content already stored in the same folder returns its existing name instead of storing a copy
+DEDUPLICATE_UPLOADS = False
+# Durable path of the deduplication index, shared by all the instances
+# (defaults to deduplication.sqlite3 next to METRICS_FILE_PATH)
+DEDUPLICATION_INDEX_PATH = None
 VALID_SIZES = []
+# Sizes rendered into the cache right after an upload, in the same format as the cache, e.g. ["320x240", "100x"]
+EAGER_RESIZE_SIZES = []
+# Ways of resizing images, picked with the profile= parameter. Each profile has a method ("sample", "resize"
+# or "two-stage"), and optionally a filter (e.g. "lanczos", "triangle"), a quality (JPEG/WebP, 1-100),
+# a webp_method (0-6) and a png_compression_level (0-9)
+RESIZE_PROFILES = {
+    "fast": {"method": "sample"},
+    "balanced": {"method": "two-stage", "filter": "triangle"},
+    "quality": {"method": "resize", "filter": "lanczos"},
+}
+# Profile used when the profile= parameter is not given
+DEFAULT_RESIZE_PROFILE = "fast"
+# Resized images are served in the first of these formats the client accepts, e.g. ["avif", "webp"] (empty disables it)
+NEGOTIATED_OUTPUT_TYPES = []
 
 #########################################
 ######          File types          #####
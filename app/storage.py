@@ -1,3 +1,4 @@
+import atexit
 import datetime
 import fcntl
 import json
@@ -5,20 +6,107 @@ import logging
 import mimetypes
 import tempfile
 import time
-import filetype
 import os
-import subprocess
+import shutil
+import threading
+import uuid
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from werkzeug.http import parse_content_range_header, parse_etags, unquote_etag
+from cache import ExistenceCache
 from abc import ABC, abstractmethod
 import settings
 
 logger = logging.getLogger(__name__)
 
+# Direct uploads are written under this prefix by the clients, until they are finalized
+UPLOADS_PREFIX = ".uploads/"
+
+
+class InvalidRangeError(Exception):
+    pass
+
+
+class NotModifiedError(Exception):
+    """
+    Raised by `open` when the copy held by the client is still up to date.
+    Carries the validators of the file, to be sent back with the 304 response.
+    """
+
+    def __init__(self, etag, last_modified):
+        super().__init__(etag)
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class StoredFile:
+    """
+    A file opened on the storage provider.
+    Its content is streamed with `iter_chunks`, or read at once with `read` for small files.
+    """
+
+    def __init__(
+        self,
+        body,
+        content_length,
+        size,
+        etag=None,
+        last_modified=None,
+        content_range=None,
+        path=None,
+    ):
+        # File-like object positioned at the beginning of the requested content
+        self.body = body
+        # Number of bytes that will be read from the body
+        self.content_length = content_length
+        # Size of the whole file
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        # (start, stop) of the requested range, stop being exclusive. None when the whole file is read
+        self.content_range = content_range
+        # Path of the file, when it is stored on the local filesystem
+        self.path = path
+
+    def iter_chunks(self):
+        """
+        Yields the content in chunks of STREAM_CHUNK_SIZE_KB, then closes the body
+        """
+        chunk_size = settings.STREAM_CHUNK_SIZE_KB * 1024
+        remaining = self.content_length
+        try:
+            while remaining > 0:
+                chunk = self.body.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def read(self):
+        try:
+            return self.body.read(self.content_length)
+        finally:
+            self.close()
+
+    def close(self):
+        self.body.close()
+
 
 class Storage(ABC):
     @abstractmethod
-    def save(self, file, filename):
+    def save(self, file, filename, exclusive=False):
+        """
+        Should store the content of the readable file-like object `file` under `filename`.
+        The file is consumed in chunks and is never loaded in memory as a whole.
+        When `exclusive` is set, the name is reserved atomically by the storage provider,
+        and FileExistsError is raised if a file already exists under `filename`.
+        """
         pass
 
     @abstractmethod
@@ -30,9 +118,24 @@ class Storage(ABC):
         pass
 
     @abstractmethod
-    def get(self, filename):
+    def open(self, filename, byte_range=None, if_none_match=None, if_modified_since=None):
         """
-        Should return the file-path to the temporary file, as well as a function to delete the temporary file
+        Should return a StoredFile streaming the content of the file, without writing it to disk.
+        `byte_range` is an optional werkzeug Range restricting the content to a single range of bytes.
+        `if_none_match` (the raw If-None-Match header) and `if_modified_since` (a datetime) are the validators
+        of the copy held by the client. NotModifiedError is raised if it is still up to date,
+        without reading the content.
+        Raises FileNotFoundError if the file does not exist, and InvalidRangeError if the range cannot be satisfied.
+        This is a single round trip to the storage provider, there is no need to call `exists` beforehand.
+        """
+        pass
+
+    @abstractmethod
+    def get_url(self, filename):
+        """
+        Should return a URL the file can be downloaded from without going through imgpush,
+        or None if the storage provider has none. May raise FileNotFoundError if the file is known not to exist,
+        the URL of a missing file is answered with an error by the storage provider otherwise.
         """
         pass
 
@@ -53,67 +156,132 @@ class Storage(ABC):
         pass
 
 
+class DirectUploadStorage(ABC):
+    """
+    Storage providers clients can upload files to directly, see POST /uploads
+    """
+
+    @abstractmethod
+    def create_upload(self, token, content_type, size, folder):
+        """
+        Should return the URL and the form fields a client posts a file of `content_type`
+        and of at most `size` bytes to, so that it is uploaded straight to the storage provider.
+        The file is then retrieved with `peek_upload(token)` and `open_upload(token)`.
+        """
+        pass
+
+    @abstractmethod
+    def peek_upload(self, token, size):
+        """
+        Should return the first `size` bytes of the direct upload `token`, and the folder it was created for.
+        Raises FileNotFoundError if nothing was uploaded.
+        """
+        pass
+
+    @abstractmethod
+    def open_upload(self, token):
+        """
+        Should return the content of the direct upload `token` as a seekable file-like object.
+        Raises FileNotFoundError if nothing was uploaded.
+        """
+        pass
+
+    @abstractmethod
+    def promote_upload(self, token, filename):
+        """
+        Should store the direct upload `token` under `filename` as is, without it going through imgpush.
+        FileExistsError is raised if a file already exists under `filename`, as with an exclusive save.
+        """
+        pass
+
+    @abstractmethod
+    def delete_upload(self, token):
+        pass
+
+
 class FileSystemStorage(Storage):
-    def save(self, file, filename):
-        with open(os.path.join(settings.FILES_DIR, filename), "wb") as f:
-            f.write(file.read())
+    def save(self, file, filename, exclusive=False):
+        path = os.path.join(settings.FILES_DIR, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The file is written next to FILES_DIR first, then moved in place,
+        # so that a partially written file is never served
+        tmp_dir = os.path.join(settings.FILES_DIR, ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(file, f, settings.STREAM_CHUNK_SIZE_KB * 1024)
+                size = f.tell()
+            if exclusive:
+                # Unlike a rename, a hard link fails if the name is already taken
+                os.link(tmp_path, path)
+                os.remove(tmp_path)
+            else:
+                replaced_size = os.path.getsize(path) if os.path.isfile(path) else None
+                os.replace(tmp_path, path)
+                if replaced_size is not None:
+                    update_metrics(replaced_size, filename, remove=True)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        update_metrics(size, filename)
 
     def delete(self, filename):
         path = os.path.join(settings.FILES_DIR, filename)
         # dont allow to delete "."
         if (os.path.exists(path)) and (os.path.isfile(path)):
+            size = os.path.getsize(path)
             os.remove(path)
+            update_metrics(size, filename, remove=True)
 
     def exists(self, filename):
         return os.path.isfile(os.path.join(settings.FILES_DIR, filename))
 
-    def get(self, filename):
-        return os.path.join(settings.FILES_DIR, filename), lambda: None
-
-    def get_metrics(self):
-        metrics = {}
-        start_time = time.time()
-
-        for mime_type in settings.ALLOWED_MIME_FILE_TYPES:
-            extension = mimetypes.guess_extension(mime_type)
-            if extension:
-                extension = extension[1:]  # remove dot from extension
-                ps = subprocess.Popen(
-                    f"find {settings.FILES_DIR} -type f -name '*.{extension}' | wc -l",
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                )
-                nbfiles = ps.communicate()[0].split()[0].decode("utf-8")
-                size = (
-                    subprocess.check_output(
-                        [
-                            f"du -c {settings.FILES_DIR}/*.{extension} | tail -n 1 | cut -f 1"
-                        ],
-                        shell=True,
-                    )
-                    .decode("utf-8")
-                    .strip()
-                )
-                metrics[mime_type] = {"count": nbfiles, "size": size}
-
-        metrics_str = ""
-        for mime_type, data in metrics.items():
-            size_in_kilobytes = data["size"]
-            file_count = data["count"]
-
-            extension = mimetypes.guess_extension(mime_type)
-            metrics_str += f'directory_size_in_kilobytes{{service="imgpush", extension="{extension}", mime_type="{mime_type}", directory="{settings.FILES_DIR}"}} {size_in_kilobytes}\n'
-            metrics_str += f'directory_count{{service="imgpush", extension="{extension}", mime_type="{mime_type}", directory="{settings.FILES_DIR}"}} {file_count}\n'
-
-        end_time = time.time()
-        total_time = (end_time - start_time) * 1000
+    def open(self, filename, byte_range=None, if_none_match=None, if_modified_since=None):
+        path = os.path.join(settings.FILES_DIR, filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(filename)
+
+        file = open(path, "rb")
+        stat = os.fstat(file.fileno())
+        etag, last_modified = get_validators(stat)
+        if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+            file.close()
+            raise NotModifiedError(etag, last_modified)
+
+        content_range = None
+        if byte_range is not None:
+            content_range = byte_range.range_for_length(stat.st_size)
+            if content_range is None:
+                file.close()
+                raise InvalidRangeError
+            file.seek(content_range[0])
+
+        start, stop = content_range or (0, stat.st_size)
+        return StoredFile(
+            file,
+            stop - start,
+            stat.st_size,
+            etag=etag,
+            last_modified=last_modified,
+            content_range=content_range,
+            path=path,
+        )
 
-        last_execution_date = int(time.time())
-        metrics_str += f'last_execution_date{{service="imgpush-metrics-rebuilder", directory="{settings.FILES_DIR}"}} {last_execution_date}\n'
-        metrics_str += f'last_execution_time_in_milliseconds{{service="imgpush-metrics-rebuilder", directory="{settings.FILES_DIR}"}} {total_time}\n'
+    def get_url(self, filename):
+        # Local files are handed to nginx instead
+        return None
 
-        return metrics_str
+    def get_metrics(self):
+        # The counters are kept up to date by save and delete, FILES_DIR is never walked here
+        metrics_accumulator.flush()
+        return format_metrics(
+            load_metrics(),
+            f'directory="{settings.FILES_DIR}"',
+        )
 
     def __str__(self) -> str:
         return "Directory = %s" % settings.FILES_DIR
@@ -146,14 +314,20 @@ class FileSystemStorage(Storage):
             )
 
 
-class S3Storage(Storage):
+class S3Storage(Storage, DirectUploadStorage):
     def __init__(self):
-        self.s3 = boto3.client(
-            "s3",
-            endpoint_url=settings.S3_ENDPOINT,
-            aws_access_key_id=settings.S3_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        # Used by the uploads without conditional writes, files larger than the threshold are sent in parts.
+        # Conditional uploads apply the same settings in _send_parts, downloads are a single streamed GET
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE_MB * 1024 * 1024,
+            max_concurrency=settings.S3_MAX_CONCURRENCY,
         )
+        # Spares the S3 round trips for files whose existence was checked recently
+        self.existence_cache = ExistenceCache(settings.EXISTENCE_CACHE_TTL)
 
         # Check that the settings are correct
         # The endpoint should be valid
@@ -165,16 +339,138 @@ class S3Storage(Storage):
             logger.error(f"Error connecting to S3: {e}")
             exit(1)
 
-    def save(self, file, filename):
-        file_size = file.seek(0, os.SEEK_END)
-        file.seek(
-            0
-        )  # Reset the file pointer to the beginning to allow S3 to read the file
+    @property
+    def s3(self):
+        # The client is shared by the threads of a process, but its connection pool must not survive a fork
+        if self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client_pid != os.getpid():
+                    self._client = create_s3_client()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def save(self, file, filename, exclusive=False):
+        # The mime type is deduced from the extension, the same way the metrics rebuilder does
+        mime_type = mimetypes.guess_type(filename)[0]
+        extra_args = {"ContentType": mime_type} if mime_type else {}
+
+        if exclusive and settings.S3_CONDITIONAL_WRITES:
+            size = self._save_conditionally(file, filename, extra_args)
+        else:
+            if exclusive and self._is_stored(filename):
+                # Without conditional writes, the name is checked then written. Another upload could
+                # take it in between, which the length of the generated names makes unlikely
+                self.existence_cache.set(filename, True)
+                raise FileExistsError(filename)
+            # boto3 streams the file in parts (multipart upload for large files),
+            # the reader only keeps track of the number of bytes sent
+            reader = CountingReader(file)
+            self.s3.upload_fileobj(
+                reader,
+                settings.S3_BUCKET_NAME,
+                build_path(filename),
+                ExtraArgs=extra_args or None,
+                Config=self.transfer_config,
+            )
+            size = reader.size
+
+        self.existence_cache.set(filename, True)
+        update_metrics(size, filename)
+
+    def _save_conditionally(self, file, filename, extra_args):
+        """
+        Stores `file` under `filename` unless a file already exists under that name, which S3 checks itself.
+        Small files are sent in a single PUT, larger ones in parts. Returns the size of the file.
+        """
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        key = build_path(filename)
+        try:
+            if size <= settings.S3_MULTIPART_THRESHOLD_MB * 1024 * 1024:
+                self.s3.put_object(
+                    Bucket=settings.S3_BUCKET_NAME,
+                    Key=key,
+                    Body=file,
+                    IfNoneMatch="*",
+                    **extra_args,
+                )
+            else:
+                self._write_in_parts(
+                    key, extra_args, lambda upload_id: self._send_parts(file, key, upload_id)
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in [
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ]:
+                self.existence_cache.set(filename, True)
+                raise FileExistsError(filename)
+            raise
+        return size
+
+    def _write_in_parts(self, key, extra_args, send_parts):
+        """
+        Writes the object `key` with a multipart upload, whose parts are sent by `send_parts(upload_id)`.
+        The transfer manager does not support conditional writes, so the upload is driven here:
+        S3 only completes it if no object exists under `key`.
+        """
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=settings.S3_BUCKET_NAME, Key=key, **extra_args
+        )["UploadId"]
+        try:
+            parts = send_parts(upload_id)
+            self.s3.complete_multipart_upload(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+                IfNoneMatch="*",
+            )
+        except Exception:
+            # The parts already sent are kept, and billed, until the upload is aborted
+            self.s3.abort_multipart_upload(
+                Bucket=settings.S3_BUCKET_NAME, Key=key, UploadId=upload_id
+            )
+            raise
 
-        mime_type = filetype.guess(file).mime
+    def _send_parts(self, file, key, upload_id):
+        """
+        Sends `file` in parts of S3_MULTIPART_CHUNK_SIZE_MB, S3_MAX_CONCURRENCY at a time,
+        and returns the list of the parts. Only the parts being sent are held in memory.
+        """
+        chunk_size = settings.S3_MULTIPART_CHUNK_SIZE_MB * 1024 * 1024
+        futures = []
+        with ThreadPoolExecutor(settings.S3_MAX_CONCURRENCY) as executor:
+            while True:
+                pending = [future for future in futures if not future.done()]
+                if len(pending) >= settings.S3_MAX_CONCURRENCY:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                futures.append(
+                    executor.submit(
+                        self.s3.upload_part,
+                        Bucket=settings.S3_BUCKET_NAME,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=len(futures) + 1,
+                        Body=chunk,
+                    )
+                )
+        return [
+            {"PartNumber": part_number, "ETag": future.result()["ETag"]}
+            for part_number, future in enumerate(futures, start=1)
+        ]
 
-        self.s3.upload_fileobj(file, settings.S3_BUCKET_NAME, build_path(filename))
-        update_metrics(file_size, mime_type)
+    def _is_stored(self, filename):
+        try:
+            self.s3.head_object(Bucket=settings.S3_BUCKET_NAME, Key=build_path(filename))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return False
+            raise
+        return True
 
     def delete(self, filename):
         try:
@@ -185,60 +481,204 @@ class S3Storage(Storage):
         except ClientError:
             return
 
-        file_size, mime_type = object_info["ContentLength"], object_info["ContentType"]
+        file_size = object_info["ContentLength"]
 
         self.s3.delete_object(Bucket=settings.S3_BUCKET_NAME, Key=build_path(filename))
-        update_metrics(file_size, mime_type, remove=True)
+        self.existence_cache.set(filename, False)
+        update_metrics(file_size, filename, remove=True)
 
     def exists(self, filename):
+        exists = self.existence_cache.get(filename)
+        if exists is not None:
+            return exists
+
         try:
             self.s3.head_object(
                 Bucket=settings.S3_BUCKET_NAME, Key=build_path(filename)
             )
-            return True
+            exists = True
         except ClientError:
-            return False
+            exists = False
+
+        self.existence_cache.set(filename, exists)
+        return exists
 
-    def get(self, filename):
+    def open(self, filename, byte_range=None, if_none_match=None, if_modified_since=None):
+        # A single GET tells whether the file exists, there is no need for a HEAD beforehand
+        if self.existence_cache.get(filename) is False:
+            raise FileNotFoundError(filename)
+
+        try:
+            response = self.s3.get_object(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=build_path(filename),
+                **get_conditional_args(byte_range, if_none_match, if_modified_since),
+            )
+        except ClientError as e:
+            self._raise_for_get_error(filename, e)
+
+        self.existence_cache.set(filename, True)
+
+        content_length = response["ContentLength"]
+        size = content_length
+        content_range = None
+        if "ContentRange" in response:
+            # e.g. "bytes 0-99/1234"
+            content_range = parse_content_range_header(response["ContentRange"])
+            content_range, size = (content_range.start, content_range.stop), content_range.length
+
+        return StoredFile(
+            response["Body"],
+            content_length,
+            size,
+            etag=response.get("ETag"),
+            last_modified=response.get("LastModified"),
+            content_range=content_range,
+        )
+
+    def _raise_for_get_error(self, filename, error):
         """
-        Should store the file in a temporary directory
-        and return the path to the file, as well as a function to delete the file
+        Raises the exception matching the ClientError `error` of a GET of `filename`
         """
-        # Extract extension to preserve it in the temp file (needed for image processing)
-        _, extension = os.path.splitext(filename)
-        # Use tempfile.mkstemp for secure temporary file creation
-        fd, tmp_path = tempfile.mkstemp(suffix=extension)
-        os.close(fd)  # Close the file descriptor, boto3 will open it
+        error_code = error.response["Error"]["Code"]
+        if error_code in ["NoSuchKey", "404"]:
+            self.existence_cache.set(filename, False)
+            raise FileNotFoundError(filename)
+        if error_code == "InvalidRange":
+            raise InvalidRangeError
+        if error_code == "304":
+            self.existence_cache.set(filename, True)
+            headers = error.response["ResponseMetadata"].get("HTTPHeaders", {})
+            last_modified = headers.get("last-modified")
+            raise NotModifiedError(
+                headers.get("etag"),
+                parsedate_to_datetime(last_modified) if last_modified else None,
+            )
+        raise error
+
+    def get_url(self, filename):
+        # A HEAD per request would cost as much as serving the file. Without the existence cache,
+        # missing files are reported by S3 itself, nginx turns its error into a 404 in proxy mode
+        if settings.EXISTENCE_CACHE_TTL > 0 and not self.exists(filename):
+            raise FileNotFoundError(filename)
+        # Presigning is computed locally, it does not reach S3
+        return self.s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": settings.S3_BUCKET_NAME, "Key": build_path(filename)},
+            ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRATION,
+        )
 
-        self.s3.download_file(settings.S3_BUCKET_NAME, build_path(filename), tmp_path)
+    def create_upload(self, token, content_type, size, folder):
+        # S3 rejects the upload if it does not meet the conditions, the folder is kept in the metadata
+        post = self.s3.generate_presigned_post(
+            settings.S3_BUCKET_NAME,
+            build_path(UPLOADS_PREFIX + token),
+            Fields={"Content-Type": content_type, "x-amz-meta-folder": folder},
+            Conditions=[
+                {"Content-Type": content_type},
+                {"x-amz-meta-folder": folder},
+                ["content-length-range", 1, size],
+            ],
+            ExpiresIn=settings.DIRECT_UPLOAD_EXPIRATION,
+        )
+        return post["url"], post["fields"]
 
-        return tmp_path, lambda: os.remove(tmp_path)
+    def peek_upload(self, token, size):
+        response = self._get_upload(token, Range=f"bytes=0-{size - 1}")
+        with response["Body"] as body:
+            return body.read(), response.get("Metadata", {}).get("folder", "")
 
-    def get_metrics(self):
-        metrics_file = get_or_create_metrics_file()
-        metrics = json.load(metrics_file)
+    def open_upload(self, token):
+        response = self._get_upload(token)
 
-        last_execution_date = metrics.get("last_execution_date", int(time.time()))
-
-        last_execution_time_in_milliseconds = metrics.get(
-            "last_execution_time_in_milliseconds", 0
+        content = tempfile.SpooledTemporaryFile(
+            max_size=settings.MAX_SPOOL_SIZE_MB * 1024 * 1024
         )
+        try:
+            with response["Body"] as body:
+                shutil.copyfileobj(body, content, settings.STREAM_CHUNK_SIZE_KB * 1024)
+        except Exception:
+            content.close()
+            raise
+        content.seek(0)
+        return content
+
+    def _get_upload(self, token, **kwargs):
+        try:
+            return self.s3.get_object(
+                Bucket=settings.S3_BUCKET_NAME, Key=build_path(UPLOADS_PREFIX + token), **kwargs
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404", "InvalidRange"]:
+                raise FileNotFoundError(token)
+            raise
 
-        metrics_str = ""
-        for mime_type in settings.ALLOWED_MIME_FILE_TYPES:
-            data = metrics.get(mime_type, {"count": 0, "total_size": 0})
+    def promote_upload(self, token, filename):
+        source_key = build_path(UPLOADS_PREFIX + token)
+        try:
+            source = self.s3.head_object(Bucket=settings.S3_BUCKET_NAME, Key=source_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                raise FileNotFoundError(token)
+            raise
+
+        # The object is copied within S3. The copy fails if the upload was replaced in the meantime
+        copy_args = {
+            "CopySource": {"Bucket": settings.S3_BUCKET_NAME, "Key": source_key},
+            "CopySourceIfMatch": source["ETag"],
+        }
+        mime_type = mimetypes.guess_type(filename)[0]
+        extra_args = {"ContentType": mime_type} if mime_type else {}
+        key = build_path(filename)
+        if settings.S3_CONDITIONAL_WRITES:
+            # CopyObject does not support If-None-Match, unlike the completion of a multipart upload.
+            # The upload is copied as a single part, which is enough for the files accepted by imgpush (up to 5 GB)
+            def copy_part(upload_id):
+                response = self.s3.upload_part_copy(
+                    Bucket=settings.S3_BUCKET_NAME,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=1,
+                    **copy_args,
+                )
+                return [{"PartNumber": 1, "ETag": response["CopyPartResult"]["ETag"]}]
 
-            count = data["count"]
-            total_size_in_kilobytes = int(data["total_size"] / 1024)
-            extension = mimetypes.guess_extension(mime_type)
+            try:
+                self._write_in_parts(key, extra_args, copy_part)
+            except ClientError as e:
+                if e.response["Error"]["Code"] in [
+                    "PreconditionFailed",
+                    "ConditionalRequestConflict",
+                ] and self._is_stored(filename):
+                    self.existence_cache.set(filename, True)
+                    raise FileExistsError(filename)
+                raise
+        else:
+            if self._is_stored(filename):
+                self.existence_cache.set(filename, True)
+                raise FileExistsError(filename)
+            self.s3.copy_object(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=key,
+                MetadataDirective="REPLACE",
+                **copy_args,
+                **extra_args,
+            )
 
-            metrics_str += f'directory_size_in_kilobytes{{service="imgpush", extension="{extension}", mime_type="{mime_type}", bucket_name="{settings.S3_BUCKET_NAME}", in_bucket_directory="{settings.S3_FOLDER_NAME}"}} {total_size_in_kilobytes}\n'
-            metrics_str += f'directory_count{{service="imgpush", extension="{extension}", mime_type="{mime_type}", bucket_name="{settings.S3_BUCKET_NAME}", in_bucket_directory="{settings.S3_FOLDER_NAME}"}} {count}\n'
+        self.existence_cache.set(filename, True)
+        update_metrics(source["ContentLength"], filename)
 
-        metrics_str += f'last_execution_date{{service="imgpush-metrics-rebuilder", bucket_name="{settings.S3_BUCKET_NAME}", in_bucket_directory="{settings.S3_FOLDER_NAME}"}} {last_execution_date}\n'
-        metrics_str += f'last_execution_time_in_milliseconds{{service="imgpush-metrics-rebuilder", bucket_name="{settings.S3_BUCKET_NAME}", in_bucket_directory="{settings.S3_FOLDER_NAME}"}} {last_execution_time_in_milliseconds}\n'
+    def delete_upload(self, token):
+        self.s3.delete_object(
+            Bucket=settings.S3_BUCKET_NAME, Key=build_path(UPLOADS_PREFIX + token)
+        )
 
-        return metrics_str
+    def get_metrics(self):
+        metrics_accumulator.flush()
+        return format_metrics(
+            load_metrics(),
+            f'bucket_name="{settings.S3_BUCKET_NAME}", in_bucket_directory="{settings.S3_FOLDER_NAME}"',
+        )
 
     def __str__(self) -> str:
         return "Endpoint = %s\nBucket name = %s" % (
@@ -254,6 +694,60 @@ class S3Storage(Storage):
             logger.error(f"Error connecting to S3: {e}")
             raise ValueError("Error connecting to S3")
 
+        if settings.S3_CONDITIONAL_WRITES:
+            self._validate_conditional_writes()
+
+    def _validate_conditional_writes(self):
+        """
+        Writes the same object twice with If-None-Match, to check that the provider rejects the second write.
+        A provider ignoring the header would silently overwrite the files whose names collide.
+        """
+        # The object is written with the direct uploads, so it is skipped by the metrics and expired with them
+        key = build_path(f"{UPLOADS_PREFIX}conditional-writes-{uuid.uuid4().hex}")
+        try:
+            for attempt in range(2):
+                try:
+                    self.s3.put_object(
+                        Bucket=settings.S3_BUCKET_NAME, Key=key, Body=b"", IfNoneMatch="*"
+                    )
+                except ClientError as e:
+                    if attempt == 1 and e.response["Error"]["Code"] in [
+                        "PreconditionFailed",
+                        "ConditionalRequestConflict",
+                    ]:
+                        return
+                    logger.error(f"Error writing to S3 with If-None-Match: {e}")
+                    raise ValueError(
+                        "The S3 provider does not support conditional writes, disable S3_CONDITIONAL_WRITES"
+                    )
+            raise ValueError(
+                "The S3 provider ignores conditional writes, disable S3_CONDITIONAL_WRITES"
+            )
+        finally:
+            self.s3.delete_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+
+
+def create_s3_client():
+    """
+    Returns an S3 client with a connection pool large enough for the threads of the worker,
+    which retries the failed and throttled requests with backoff
+    """
+    return boto3.session.Session().client(
+        "s3",
+        endpoint_url=settings.S3_ENDPOINT,
+        aws_access_key_id=settings.S3_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+        config=Config(
+            max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            connect_timeout=settings.S3_CONNECT_TIMEOUT,
+            read_timeout=settings.S3_READ_TIMEOUT,
+            retries={
+                "mode": settings.S3_RETRY_MODE,
+                "total_max_attempts": settings.S3_MAX_ATTEMPTS,
+            },
+        ),
+    )
+
 
 def get_storage():
     if settings.S3_ENDPOINT is not None and settings.S3_ENDPOINT != "":
@@ -262,6 +756,65 @@ def get_storage():
         return FileSystemStorage()
 
 
+class CountingReader:
+    """
+    Wraps a readable file-like object and counts the bytes read from it
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.size += len(chunk)
+        return chunk
+
+
+def get_conditional_args(byte_range, if_none_match, if_modified_since):
+    """
+    Returns the arguments of a GetObject request restricted to `byte_range`,
+    and conditioned on the validators of the copy held by the client
+    """
+    args = {}
+    if byte_range is not None:
+        # S3 understands the HTTP Range header as is
+        args["Range"] = byte_range.to_header()
+    # S3 answers 304 without the body. If-Modified-Since is ignored when If-None-Match is set, as in RFC 9110
+    if if_none_match:
+        args["IfNoneMatch"] = if_none_match
+    elif if_modified_since is not None:
+        args["IfModifiedSince"] = if_modified_since
+    return args
+
+
+def get_validators(stat):
+    """
+    Returns the ETag and the Last-Modified date of a local file, from its `os.stat` result.
+    The ETag has the format of nginx's, so that it does not change when nginx sends the file.
+    """
+    etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+    last_modified = datetime.datetime.fromtimestamp(
+        int(stat.st_mtime), datetime.timezone.utc
+    )
+    return etag, last_modified
+
+
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+    """
+    Tells whether the copy held by the client, described by the raw If-None-Match header
+    and the If-Modified-Since date, is still up to date. If-None-Match takes precedence.
+    """
+    if if_none_match:
+        return etag is not None and parse_etags(if_none_match).contains_weak(
+            unquote_etag(etag)[0]
+        )
+    if if_modified_since is not None and last_modified is not None:
+        # HTTP dates have a one second resolution
+        return last_modified.replace(microsecond=0) <= if_modified_since
+    return False
+
+
 def build_path(filename):
     return os.path.join(settings.S3_FOLDER_NAME, filename)
 
@@ -269,51 +822,211 @@ def build_path(filename):
 def get_or_create_metrics_file():
     # Create the metrics folder if it does not exist
     if not os.path.exists(os.path.dirname(settings.METRICS_FILE_PATH)):
-        os.makedirs(os.path.dirname(settings.METRICS_FILE_PATH))
+        os.makedirs(os.path.dirname(settings.METRICS_FILE_PATH), exist_ok=True)
         logger.info(
             f"Directory {os.path.dirname(settings.METRICS_FILE_PATH)} does not exist. Creating it."
         )
 
-    # Create the metrics file if it does not exist
+    # Create the metrics file if it does not exist, without emptying it if another worker just did
     if not os.path.exists(settings.METRICS_FILE_PATH):
         logger.info(f"File {settings.METRICS_FILE_PATH} does not exist. Creating it.")
-        open(settings.METRICS_FILE_PATH, "w").write("{}")
+        try:
+            with open(settings.METRICS_FILE_PATH, "x") as metrics_file:
+                metrics_file.write("{}")
+        except FileExistsError:
+            pass
 
     return open(settings.METRICS_FILE_PATH)
 
 
-def update_metrics(file_size, mime_type, remove=False):
-    try:
-        # Ensure the metrics file exists
-        get_or_create_metrics_file().close()
+def rewrite_metrics_file(update):
+    """
+    Replaces the content of the metrics file with `update(metrics)`, `metrics` being its current content
+    """
+    get_or_create_metrics_file().close()
 
-        # Open file for read/write and acquire exclusive lock
-        with open(settings.METRICS_FILE_PATH, "r+") as metrics_file:
-            # Acquire exclusive lock to prevent race conditions
-            fcntl.flock(metrics_file.fileno(), fcntl.LOCK_EX)
+    # The file is replaced rather than rewritten, so readers never see it half-written,
+    # hence the lock on a separate file
+    with open(f"{settings.METRICS_FILE_PATH}.lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
 
+        with open(settings.METRICS_FILE_PATH) as metrics_file:
             try:
                 metrics = json.load(metrics_file)
             except json.JSONDecodeError:
                 metrics = {}
+        metrics = update(metrics)
+
+        directory = os.path.dirname(settings.METRICS_FILE_PATH)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(metrics, tmp_file)
+        os.replace(tmp_path, settings.METRICS_FILE_PATH)
+
+
+def get_mime_type(filename):
+    """
+    Returns the mime type the metrics of `filename` are grouped under, deduced from its extension
+    """
+    _, extension = os.path.splitext(filename)
+    return mimetypes.types_map.get(extension, "others")
+
+
+def get_folder(filename):
+    """
+    Returns the folder the metrics of `filename` are grouped under, "" for the root
+    """
+    return os.path.dirname(filename)
+
+
+def add_to_metrics(metrics, filename, file_size, count=1):
+    """
+    Adds `count` files of `file_size` bytes named `filename` to the `metrics` dictionary,
+    both to the totals by mime type and to the breakdown by folder
+    """
+    mime_type = get_mime_type(filename)
+    folders = metrics.setdefault("folders", {})
+
+    for data in [
+        metrics.setdefault(mime_type, {"count": 0, "total_size": 0}),
+        folders.setdefault(get_folder(filename), {}).setdefault(
+            mime_type, {"count": 0, "total_size": 0}
+        ),
+    ]:
+        data["count"] += count
+        data["total_size"] += count * file_size
+
+
+_loaded_metrics = {"key": None, "metrics": {}}
+
+
+def load_metrics():
+    """
+    Returns the content of the metrics file. It is only parsed again once the file changed,
+    so that a scrape usually costs a single stat
+    """
+    get_or_create_metrics_file().close()
+    stat = os.stat(settings.METRICS_FILE_PATH)
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    if _loaded_metrics["key"] != key:
+        with open(settings.METRICS_FILE_PATH) as metrics_file:
+            try:
+                _loaded_metrics["metrics"] = json.load(metrics_file)
+            except json.JSONDecodeError:
+                _loaded_metrics["metrics"] = {}
+        _loaded_metrics["key"] = key
+    return _loaded_metrics["metrics"]
+
+
+def format_metrics(metrics, storage_labels):
+    """
+    Returns the `metrics` dictionary as a Prometheus formatted string,
+    `storage_labels` identifying the directory or bucket they describe
+    """
+    last_execution_date = metrics.get("last_execution_date", int(time.time()))
+    last_execution_time_in_milliseconds = metrics.get(
+        "last_execution_time_in_milliseconds", 0
+    )
+
+    metrics_str = ""
+    for mime_type in settings.ALLOWED_MIME_FILE_TYPES:
+        data = metrics.get(mime_type, {"count": 0, "total_size": 0})
+
+        count = data["count"]
+        total_size_in_kilobytes = int(data["total_size"] / 1024)
+        extension = mimetypes.guess_extension(mime_type)
+        labels = f'service="imgpush", extension="{extension}", mime_type="{mime_type}", {storage_labels}'
+
+        metrics_str += f"directory_size_in_kilobytes{{{labels}}} {total_size_in_kilobytes}\n"
+        metrics_str += f"directory_count{{{labels}}} {count}\n"
+
+    for folder, folder_metrics in sorted(metrics.get("folders", {}).items()):
+        for mime_type, data in sorted(folder_metrics.items()):
+            if not data["count"]:
+                continue
+            total_size_in_kilobytes = int(data["total_size"] / 1024)
+            labels = f'service="imgpush", folder="{folder}", mime_type="{mime_type}", {storage_labels}'
+            metrics_str += f"folder_size_in_kilobytes{{{labels}}} {total_size_in_kilobytes}\n"
+            metrics_str += f"folder_count{{{labels}}} {data['count']}\n"
+
+    labels = f'service="imgpush-metrics-rebuilder", {storage_labels}'
+    metrics_str += f"last_execution_date{{{labels}}} {last_execution_date}\n"
+    metrics_str += f"last_execution_time_in_milliseconds{{{labels}}} {last_execution_time_in_milliseconds}\n"
+
+    return metrics_str
+
+
+def merge_metrics(metrics, deltas):
+    """
+    Adds the counts and sizes of the `deltas` dictionary to the `metrics` dictionary
+    """
+    for key, data in deltas.items():
+        if key == "folders":
+            folders = metrics.setdefault("folders", {})
+            for folder, folder_deltas in data.items():
+                merge_metrics(folders.setdefault(folder, {}), folder_deltas)
+        else:
+            totals = metrics.setdefault(key, {"count": 0, "total_size": 0})
+            totals["count"] += data["count"]
+            totals["total_size"] += data["total_size"]
+
+
+class MetricsAccumulator:
+    """
+    Accumulates the changes to the metrics in memory, and merges them into METRICS_FILE_PATH
+    every `interval` seconds, from a daemon thread, as well as when the worker exits.
+
+    Saves and deletes only update a dictionary, they never wait for the metrics file.
+    Each worker merges its own changes, so the file holds the total of all the workers,
+    and survives restarts.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def add(self, filename, file_size, count):
+        with self._lock:
+            add_to_metrics(self._deltas, filename, file_size, count)
+            # The thread is started by the worker itself, as threads do not survive a fork
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="metrics-flush", daemon=True
+                )
+                self._thread.start()
 
-            data = metrics.get(mime_type, {"count": 0, "total_size": 0})
+    def flush(self):
+        """
+        Merges the accumulated changes into the metrics file
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return
+
+        def merge(metrics):
+            merge_metrics(metrics, deltas)
+            return metrics
+
+        try:
+            rewrite_metrics_file(merge)
+        except Exception as e:
+            logger.error(f"Error updating metrics: {e}")
+            # The changes are kept for the next flush
+            with self._lock:
+                merge_metrics(self._deltas, deltas)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
-            if remove:
-                data["count"] -= 1
-                data["total_size"] -= file_size
-            else:
-                data["count"] += 1
-                data["total_size"] += file_size
 
-            metrics[mime_type] = data
+metrics_accumulator = MetricsAccumulator(settings.METRICS_FLUSH_INTERVAL)
 
-            # Rewrite the file from the beginning
-            metrics_file.seek(0)
-            metrics_file.truncate()
-            json.dump(metrics, metrics_file)
 
-            # Lock is automatically released when file is closed
-    except Exception as e:
-        logger.error(f"Error updating metrics: {e}")
-        return
+def update_metrics(file_size, filename, remove=False):
+    metrics_accumulator.add(filename, file_size, -1 if remove else 1)
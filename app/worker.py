@@ -0,0 +1,44 @@
+"""
+Code running in the job processes.
+This module must not import prometheus_client, directly or not: in multiprocess mode,
+every short-lived job process would otherwise leave its own files in PROMETHEUS_MULTIPROC_DIR.
+The time spent in each stage is sent back instead, and recorded by the gunicorn worker.
+"""
+import contextlib
+import time
+
+# Stages timed by the current job, as (stage, seconds)
+_stages = []
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times the block as the stage `name` of the current job
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stages.append((name, time.perf_counter() - started_at))
+
+
+def run_job(connection, initializer, function, args):
+    """
+    Entry point of the job process: sends back the result or the exception raised by the job,
+    along with when the job started and finished, and the time spent in each of its stages
+    """
+    started_at = time.time()
+    try:
+        if initializer is not None:
+            initializer()
+        result = function(*args)
+        connection.send(("ok", result, started_at, time.time(), _stages))
+    except Exception as e:
+        try:
+            connection.send(("error", e, started_at, time.time(), _stages))
+        except Exception:
+            # The exception could not be pickled
+            connection.send(("failed", repr(e), started_at, time.time(), _stages))
+    finally:
+        connection.close()
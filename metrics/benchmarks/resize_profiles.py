@@ -0,0 +1,65 @@
+"""
+Measures the latency, the throughput and the output size of each resize profile
+of RESIZE_PROFILES, on JPEG images of several sizes.
+
+Usage, from the root of the repository, with ImageMagick and the requirements installed:
+    CACHE_DIR=/tmp/imgpush-benchmark PYTHONPATH=app python3 metrics/benchmarks/resize_profiles.py
+"""
+import os
+import statistics
+import tempfile
+import time
+
+from wand.image import Image
+
+import images
+import settings
+
+SOURCE_SIZES = [(1200, 800), (3000, 2000), (6000, 4000)]
+TARGET_SIZES = [(200, 200), (800, "")]
+REPETITIONS = 10
+
+
+def make_source(width, height):
+    """
+    Returns a JPEG photo-like image of the given size, as bytes
+    """
+    with Image(width=width, height=height, pseudo="plasma:") as img:
+        img.format = "jpeg"
+        img.compression_quality = 90
+        return img.make_blob()
+
+
+def measure(source, width, height, profile_name):
+    """
+    Returns the durations of the resizes in milliseconds, and the size of the output in bytes
+    """
+    durations = []
+    with tempfile.TemporaryDirectory() as directory:
+        destination = os.path.join(directory, "resized.jpg")
+        for _ in range(REPETITIONS):
+            started_at = time.perf_counter()
+            images.resize_image(source, destination, width, height, profile_name)
+            durations.append((time.perf_counter() - started_at) * 1000)
+        return durations, os.path.getsize(destination)
+
+
+def main():
+    print("| Source    | Size      | Profile    | Median (ms) | p95 (ms) | Images/s | Output (KB) |")
+    print("| --------- | --------- | ---------- | ----------- | -------- | -------- | ----------- |")
+    for source_width, source_height in SOURCE_SIZES:
+        source = make_source(source_width, source_height)
+        for width, height in TARGET_SIZES:
+            for profile_name in settings.RESIZE_PROFILES:
+                durations, output_size = measure(source, width, height, profile_name)
+                median = statistics.median(durations)
+                p95 = sorted(durations)[int(len(durations) * 0.95) - 1]
+                throughput = 1000 / statistics.mean(durations)
+                print(
+                    f"| {source_width}x{source_height:<4} | {f'{width}x{height}':<9} | {profile_name:<10} "
+                    f"| {median:>11.1f} | {p95:>8.1f} | {throughput:>8.1f} | {output_size / 1024:>11.1f} |"
+                )
+
+
+if __name__ == "__main__":
+    main()
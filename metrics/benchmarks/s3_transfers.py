@@ -0,0 +1,103 @@
+"""
+Measures the throughput of the uploads and downloads of imgpush to S3 at several concurrency levels,
+through the same calls as the application: S3Storage.save with a reserved name, and S3Storage.open.
+Files larger than S3_MULTIPART_THRESHOLD_MB are uploaded in parts of S3_MULTIPART_CHUNK_SIZE_MB,
+S3_MAX_CONCURRENCY at a time. Downloads are always a single streamed GET.
+Run it once per configuration, changing the S3_* settings in between, and compare the tables.
+
+Usage, from the root of the repository, against a local S3 stand-in such as MinIO:
+    docker run --rm -d -p 9000:9000 -e MINIO_ROOT_USER=accesskey -e MINIO_ROOT_PASSWORD=secretkey \\
+        minio/minio server /data
+    S3_ENDPOINT=http://localhost:9000 S3_ACCESS_KEY_ID=accesskey S3_SECRET_ACCESS_KEY=secretkey \\
+        S3_BUCKET_NAME=imgpush-benchmark METRICS_FILE_PATH=/tmp/imgpush-benchmark/metrics.json \\
+        S3_MAX_CONCURRENCY=10 PYTHONPATH=app python3 metrics/benchmarks/s3_transfers.py
+"""
+import io
+import os
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from storage import S3Storage, build_path, create_s3_client
+
+# Size of the files in bytes, and number of transfers of each file per concurrency level
+FILE_SIZES = [(256 * 1024, 256), (16 * 1024 * 1024, 8)]
+CONCURRENCY_LEVELS = [1, 4, 16, 64]
+# Each run writes under its own prefix, so that the names reserved by a previous run never collide
+PREFIX = f"imgpush-benchmark-{uuid.uuid4().hex[:8]}/"
+
+
+def measure(storage, operation, content, count, concurrency):
+    """
+    Runs `count` saves or opens of `content`, `concurrency` at a time,
+    and returns the durations in milliseconds and the total elapsed time in seconds
+    """
+
+    def transfer(index):
+        filename = f"{PREFIX}{len(content)}-{concurrency}-{index}.bin"
+        started_at = time.perf_counter()
+        if operation == "save":
+            storage.save(io.BytesIO(content), filename, exclusive=True)
+        else:
+            stored_file = storage.open(filename)
+            try:
+                stored_file.read()
+            finally:
+                stored_file.close()
+        return (time.perf_counter() - started_at) * 1000
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        durations = list(executor.map(transfer, range(count)))
+    return durations, time.perf_counter() - started_at
+
+
+def cleanup(client):
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=build_path(PREFIX)):
+        objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if objects:
+            client.delete_objects(
+                Bucket=settings.S3_BUCKET_NAME, Delete={"Objects": objects}
+            )
+
+
+def main():
+    # The bucket is created before the storage, which checks that it exists
+    client = create_s3_client()
+    try:
+        client.create_bucket(Bucket=settings.S3_BUCKET_NAME)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    storage = S3Storage()
+
+    print(
+        f"S3_MULTIPART_THRESHOLD_MB={settings.S3_MULTIPART_THRESHOLD_MB} "
+        f"S3_MULTIPART_CHUNK_SIZE_MB={settings.S3_MULTIPART_CHUNK_SIZE_MB} "
+        f"S3_MAX_CONCURRENCY={settings.S3_MAX_CONCURRENCY} "
+        f"S3_MAX_POOL_CONNECTIONS={settings.S3_MAX_POOL_CONNECTIONS} "
+        f"S3_CONDITIONAL_WRITES={settings.S3_CONDITIONAL_WRITES}"
+    )
+    print("| File      | Operation | Concurrency | Median (ms) | p95 (ms) | Transfers/s | MB/s    |")
+    print("| --------- | --------- | ----------- | ----------- | -------- | ----------- | ------- |")
+    try:
+        for size, count in FILE_SIZES:
+            content = os.urandom(size)
+            for concurrency in CONCURRENCY_LEVELS:
+                for operation in ["save", "open"]:
+                    durations, elapsed = measure(storage, operation, content, count, concurrency)
+                    median = statistics.median(durations)
+                    p95 = sorted(durations)[int(len(durations) * 0.95) - 1]
+                    print(
+                        f"| {f'{size // 1024} KB':<9} | {operation:<9} | {concurrency:>11} "
+                        f"| {median:>11.1f} | {p95:>8.1f} | {count / elapsed:>11.1f} "
+                        f"| {count * size / elapsed / 1024 / 1024:>7.1f} |"
+                    )
+    finally:
+        cleanup(client)
+
+
+if __name__ == "__main__":
+    main()
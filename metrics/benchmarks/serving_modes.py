@@ -0,0 +1,49 @@
+"""
+Measures the latency and the throughput of a running imgpush when serving a file,
+to compare the serving modes (S3_SERVING_MODE, NGINX_ACCEL_REDIRECT).
+Run it once per mode, against the same file, restarting imgpush with the mode to measure in between.
+
+Usage, against an imgpush listening on http://localhost:5000:
+    python3 metrics/benchmarks/serving_modes.py http://localhost:5000/somename.jpg [concurrency] [requests]
+"""
+import statistics
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fetch(url):
+    """
+    Downloads `url`, following the redirections, and returns the duration and the number of bytes received
+    """
+    started_at = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        size = len(response.read())
+    return time.perf_counter() - started_at, size
+
+
+def main():
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    # Warms up the caches of imgpush, nginx and S3
+    fetch(url)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(fetch, [url] * requests))
+    elapsed = time.perf_counter() - started_at
+
+    durations = sorted(duration * 1000 for duration, _ in results)
+    received = sum(size for _, size in results)
+    print(f"Requests:     {requests} ({concurrency} concurrent)")
+    print(f"Throughput:   {requests / elapsed:.1f} requests/s, {received / elapsed / 1024 / 1024:.1f} MB/s")
+    print(f"Median:       {statistics.median(durations):.1f} ms")
+    print(f"p95:          {durations[int(len(durations) * 0.95) - 1]:.1f} ms")
+    print(f"p99:          {durations[int(len(durations) * 0.99) - 1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
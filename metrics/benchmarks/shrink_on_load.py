@@ -0,0 +1,59 @@
+"""
+Measures the time taken to resize JPEG images of several sizes into thumbnails,
+with and without decoding them at a reduced scale (SHRINK_ON_LOAD).
+
+Usage, from the root of the repository, with ImageMagick and the requirements installed:
+    CACHE_DIR=/tmp/imgpush-benchmark PYTHONPATH=app python3 metrics/benchmarks/shrink_on_load.py
+"""
+import os
+import tempfile
+import time
+
+from wand.image import Image
+
+import images
+import settings
+
+SOURCE_SIZES = [(1200, 800), (3000, 2000), (6000, 4000)]
+TARGET_WIDTHS = [200, 800]
+REPETITIONS = 5
+
+
+def make_source(width, height):
+    """
+    Returns a JPEG photo-like image of the given size, as bytes
+    """
+    with Image(width=width, height=height, pseudo="plasma:") as img:
+        img.format = "jpeg"
+        img.compression_quality = 90
+        return img.make_blob()
+
+
+def measure(source, width, shrink_on_load):
+    settings.SHRINK_ON_LOAD = shrink_on_load
+    with tempfile.TemporaryDirectory() as directory:
+        destination = os.path.join(directory, "resized.jpg")
+        started_at = time.perf_counter()
+        for _ in range(REPETITIONS):
+            images.resize_image(
+                source, destination, width, "", settings.DEFAULT_RESIZE_PROFILE
+            )
+        return (time.perf_counter() - started_at) / REPETITIONS * 1000
+
+
+def main():
+    print("| Source    | Width | Full decode (ms) | Shrink on load (ms) | Speed-up |")
+    print("| --------- | ----- | ---------------- | ------------------- | -------- |")
+    for source_width, source_height in SOURCE_SIZES:
+        source = make_source(source_width, source_height)
+        for width in TARGET_WIDTHS:
+            full = measure(source, width, False)
+            shrunk = measure(source, width, True)
+            print(
+                f"| {source_width}x{source_height:<4} | {width:<5} | {full:>16.1f} "
+                f"| {shrunk:>19.1f} | {full / shrunk:>7.1f}x |"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The modules of the application are imported as in the Docker image, from the app directory,
+# and read their settings from the environment when they are first imported
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("METRICS_FILE_PATH", os.path.join(tempfile.mkdtemp(), "metrics.json"))
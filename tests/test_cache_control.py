@@ -0,0 +1,35 @@
+"""
+Caching headers of the files served by imgpush
+"""
+import pytest
+
+import settings
+
+
+@pytest.fixture(scope="module")
+def files_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("files")
+
+
+@pytest.fixture(scope="module")
+def client(files_dir, tmp_path_factory):
+    # The application requires ImageMagick, which wand loads when imported
+    pytest.importorskip("wand.image", exc_type=ImportError)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(settings, "FILES_DIR", str(files_dir))
+        monkeypatch.setattr(settings, "CACHE_DIR", str(tmp_path_factory.mktemp("cache")))
+        monkeypatch.setattr(settings, "NGINX_ACCEL_REDIRECT", False)
+        monkeypatch.setattr(settings, "CACHE_CONTROL_MAX_AGE", 3600)
+        monkeypatch.setattr(settings, "CACHE_CONTROL_IMMUTABLE", True)
+        import app
+
+        yield app.app.test_client()
+
+
+def test_local_files_are_not_marked_no_cache(client, files_dir):
+    (files_dir / "document.pdf").write_bytes(b"%PDF-1.4\n")
+
+    response = client.get("/document.pdf")
+
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "public, max-age=3600, immutable"
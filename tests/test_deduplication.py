@@ -0,0 +1,42 @@
+"""
+Reference counting of the deduplication index
+"""
+import pytest
+
+from deduplication import DeduplicationIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DeduplicationIndex(str(tmp_path / "deduplication.sqlite3"))
+
+
+def test_same_content_is_counted_once_per_upload(index):
+    assert index.acquire("digest", "", "png") is None
+    assert index.register("digest", "", "png", "a.png") == "a.png"
+    assert index.acquire("digest", "", "png") == "a.png"
+
+    assert index.release("a.png") is False
+    assert index.release("a.png") is True
+    assert index.acquire("digest", "", "png") is None
+
+
+def test_concurrent_upload_of_the_same_content_gets_the_registered_name(index):
+    assert index.register("digest", "", "png", "a.png") == "a.png"
+    assert index.register("digest", "", "png", "b.png") == "a.png"
+
+    assert index.release("a.png") is False
+    assert index.release("a.png") is True
+
+
+def test_different_contents_stored_under_the_same_name_share_its_references(index):
+    # Two uploads converted to the same image get the same content hash name
+    assert index.register("first", "", "png", "same.png") == "same.png"
+    assert index.register("second", "", "png", "same.png") == "same.png"
+    assert index.acquire("second", "", "png") == "same.png"
+
+    assert index.release("same.png") is False
+    assert index.release("same.png") is False
+    assert index.release("same.png") is True
+    assert index.acquire("first", "", "png") is None
+    assert index.acquire("second", "", "png") is None
@@ -0,0 +1,103 @@
+"""
+Direct uploads against a local S3 stand-in (moto), from the presigned post to the stored file
+"""
+import os
+import uuid
+
+import pytest
+
+moto_server = pytest.importorskip("moto.server")
+requests = pytest.importorskip("requests")
+
+import settings  # noqa: E402
+from storage import DirectUploadStorage, FileSystemStorage, S3Storage, create_s3_client  # noqa: E402
+
+PORT = 5123
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+PDF = b"%PDF-1.4\n" + os.urandom(2048)
+
+
+@pytest.fixture(scope="module")
+def storage():
+    server = moto_server.ThreadedMotoServer(port=PORT, verbose=False)
+    server.start()
+    try:
+        # The settings are shared by all the tests, they only point to the stand-in for these ones
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(settings, "S3_ENDPOINT", f"http://localhost:{PORT}")
+            monkeypatch.setattr(settings, "S3_ACCESS_KEY_ID", "accesskey")
+            monkeypatch.setattr(settings, "S3_SECRET_ACCESS_KEY", "secretkey")
+            monkeypatch.setattr(settings, "S3_BUCKET_NAME", "imgpush-test")
+            create_s3_client().create_bucket(Bucket=settings.S3_BUCKET_NAME)
+            yield S3Storage()
+    finally:
+        server.stop()
+
+
+@pytest.fixture(params=[True, False], ids=["conditional", "head-then-copy"])
+def conditional_writes(request, monkeypatch):
+    monkeypatch.setattr(settings, "S3_CONDITIONAL_WRITES", request.param)
+    return request.param
+
+
+def upload(storage, content, folder=""):
+    token = uuid.uuid4().hex
+    url, fields = storage.create_upload(token, "application/pdf", len(content), folder)
+    response = requests.post(url, data=fields, files={"file": ("file.pdf", content)})
+    assert response.status_code in (200, 201, 204)
+    return token
+
+
+def test_only_s3_accepts_direct_uploads():
+    assert issubclass(S3Storage, DirectUploadStorage)
+    assert not issubclass(FileSystemStorage, DirectUploadStorage)
+
+
+def test_peek_and_open_upload(storage):
+    token = upload(storage, PDF, folder="docs")
+
+    head, folder = storage.peek_upload(token, 8)
+    assert head == PDF[:8]
+    assert folder == "docs"
+    with storage.open_upload(token) as content:
+        assert content.read() == PDF
+
+    storage.delete_upload(token)
+    with pytest.raises(FileNotFoundError):
+        storage.peek_upload(token, 8)
+
+
+def test_promote_upload_copies_the_file(storage, conditional_writes):
+    token = upload(storage, PDF)
+    filename = f"docs/{uuid.uuid4().hex}.pdf"
+
+    storage.promote_upload(token, filename)
+
+    stored_file = storage.open(filename)
+    try:
+        assert stored_file.read() == PDF
+    finally:
+        stored_file.close()
+    stored_object = storage.s3.head_object(Bucket=settings.S3_BUCKET_NAME, Key=filename)
+    assert stored_object["ContentType"] == "application/pdf"
+    assert "folder" not in stored_object["Metadata"]
+
+
+def test_promote_upload_never_overwrites(storage, conditional_writes):
+    filename = f"docs/{uuid.uuid4().hex}.pdf"
+    storage.promote_upload(upload(storage, PDF), filename)
+
+    with pytest.raises(FileExistsError):
+        storage.promote_upload(upload(storage, b"%PDF-1.4\nother"), filename)
+
+    stored_file = storage.open(filename)
+    try:
+        assert stored_file.read() == PDF
+    finally:
+        stored_file.close()
+
+
+def test_promote_missing_upload(storage):
+    with pytest.raises(FileNotFoundError):
+        storage.promote_upload(uuid.uuid4().hex, f"{uuid.uuid4().hex}.pdf")
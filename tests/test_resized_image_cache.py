@@ -0,0 +1,35 @@
+"""
+Single-flight rendering of the resized images cache
+"""
+import pytest
+
+import settings
+from cache import ResizedImageCache, single_flight
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_DIR", str(tmp_path))
+    return ResizedImageCache(str(tmp_path))
+
+
+def write(path):
+    with open(path, "wb") as variant:
+        variant.write(b"variant")
+
+
+def test_non_blocking_render_skips_a_variant_being_rendered(cache):
+    rendered = []
+
+    with single_flight("image_100x100.png"):
+        path = cache.render("image_100x100.png", rendered.append, blocking=False)
+
+    assert path is None
+    assert rendered == []
+
+
+def test_non_blocking_render_renders_a_variant_nobody_renders(cache, tmp_path):
+    path = cache.render("image_100x100.png", write, blocking=False)
+
+    assert path == str(tmp_path / "image_100x100.png")
+    assert (tmp_path / "image_100x100.png").read_bytes() == b"variant"